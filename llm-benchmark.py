@@ -0,0 +1,432 @@
+import os
+import re
+import sys
+import json
+import time
+import zlib
+import random
+import struct
+import argparse
+import tempfile
+import threading
+import subprocess
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+
+WORDS = ("the of and to in a is that for it as was with be by on not he this are or his from at which but have an "
+         "they you were her she there been one all we their has would when if so no will more about can said up "
+         "report budget quarterly meeting project analysis results market research data system design review "
+         "customer product development strategy revenue growth team annual summary proposal contract schedule").split()
+
+SCENARIOS = {
+    'sequential': [],
+    'pipelined': ['--workers', '4', '--extract-workers', '2'],
+    'multitask': ['--workers', '4', '--extract-workers', '2', '--task-config', 'task_config.json', '--tasks', 'metadata', 'info', 'json'],
+    'fused': ['--workers', '4', '--extract-workers', '2', '--task-config', 'task_config.json', '--tasks', 'metadata', 'info', 'json', '--fuse-tasks'],
+}
+
+
+class MockKobold:
+    # Stands in for koboldcpp: latency follows prompt and output length, and each server runs `slots` generations at once
+    def __init__(self, port=0, context=8192, prompt_rate=2000.0, gen_rate=40.0, overhead=0.02, output_tokens=48, caption_latency=0.3, slots=1):
+        self.context = context
+        self.prompt_rate = prompt_rate
+        self.gen_rate = gen_rate
+        self.overhead = overhead
+        self.output_tokens = output_tokens
+        self.caption_latency = caption_latency
+        self.slots = threading.Semaphore(slots)
+        self.lock = threading.Lock()
+        self.reset()
+        self.server = ThreadingHTTPServer(('127.0.0.1', port), self.handler())
+        self.server.daemon_threads = True
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}/api"
+
+    def reset(self):
+        with self.lock:
+            self.counts = {}
+            self.latencies = {}
+            self.bytes_received = 0
+            self.perf = {}
+
+    def record(self, endpoint, size, seconds):
+        with self.lock:
+            self.counts[endpoint] = self.counts.get(endpoint, 0) + 1
+            self.latencies.setdefault(endpoint, []).append(seconds)
+            self.bytes_received += size
+
+    def start(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    @staticmethod
+    def count_tokens(text):
+        return max(1, len(text) // 4)
+
+    def generate(self, payload):
+        prompt_tokens = self.count_tokens(payload.get('prompt', ''))
+        output_tokens = min(payload.get('max_length', self.output_tokens), self.output_tokens)
+        with self.slots:
+            time.sleep(self.overhead + prompt_tokens / self.prompt_rate + output_tokens / self.gen_rate)
+        with self.lock:
+            self.perf = {'last_process': prompt_tokens / self.prompt_rate, 'last_eval': output_tokens / self.gen_rate,
+                         'last_input_count': prompt_tokens, 'last_token_count': output_tokens}
+        keys = re.search(r'with the keys ((?:"[^"]+"(?:, )?)+)', payload.get('prompt', ''))
+        answer = {'title': 'Benchmark Document', 'author': 'Mock Author', 'subject': 'Testing', 'filename': 'benchmark_document'}
+        if keys:
+            # A fused request; the metadata task still needs its object
+            answer = {key: answer if key == 'metadata' else "Mock answer" for key in re.findall(r'"([^"]+)"', keys.group(1))}
+        return json.dumps(answer)
+
+    def handler(self):
+        mock = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, *args):
+                pass
+
+            def send_json(self, obj):
+                body = json.dumps(obj).encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_GET(self):
+                start = time.perf_counter()
+                path = self.path.rstrip('/')
+                if path.endswith('/extra/true_max_context_length'):
+                    self.send_json({'value': mock.context})
+                elif path.endswith('/extra/perf'):
+                    self.send_json(mock.perf)
+                else:
+                    self.send_json({})
+                mock.record(path.split('/api', 1)[-1], 0, time.perf_counter() - start)
+
+            def do_POST(self):
+                start = time.perf_counter()
+                size = int(self.headers.get('Content-Length', 0))
+                payload = json.loads(self.rfile.read(size) or b'{}')
+                path = self.path.rstrip('/')
+                if path.endswith('/extra/tokencount'):
+                    self.send_json({'value': mock.count_tokens(payload.get('prompt', ''))})
+                elif path.endswith('/extra/generate/check'):
+                    self.send_json({'results': [{'text': ''}]})
+                elif path.endswith('/sdapi/v1/interrogate'):
+                    time.sleep(mock.caption_latency)
+                    self.send_json({'caption': 'a photograph used for benchmarking'})
+                elif path.endswith('/v1/generate'):
+                    self.send_json({'results': [{'text': mock.generate(payload)}]})
+                elif path.endswith('/extra/generate/stream'):
+                    text = mock.generate(payload)
+                    self.send_response(200)
+                    self.send_header('Content-Type', 'text/event-stream')
+                    self.send_header('Connection', 'close')
+                    self.end_headers()
+                    for index in range(0, len(text), 8):
+                        event = json.dumps({'token': text[index:index + 8]})
+                        self.wfile.write(f"event: message\ndata: {event}\n\n".encode())
+                    self.close_connection = True
+                else:
+                    self.send_json({})
+                mock.record(path.split('/api', 1)[-1], size, time.perf_counter() - start)
+
+        return Handler
+
+
+def random_text(rng, size):
+    sentences = []
+    length = 0
+    while length < size:
+        words = [rng.choice(WORDS) for _ in range(rng.randint(6, 24))]
+        sentence = " ".join(words).capitalize() + rng.choice(".....?!")
+        if rng.random() < 0.15:
+            sentence += "\n\n"
+        sentences.append(sentence)
+        length += len(sentence) + 1
+    return " ".join(sentences)[:size]
+
+
+def write_pdf(path, text, lines_per_page=50):
+    # A minimal single-font PDF; enough for tika to extract real text
+    lines = []
+    for paragraph in text.split("\n"):
+        while paragraph:
+            lines.append(paragraph[:90])
+            paragraph = paragraph[90:]
+    pages = [lines[i:i + lines_per_page] for i in range(0, max(1, len(lines)), lines_per_page)] or [[]]
+    objects = ["<< /Type /Catalog /Pages 2 0 R >>", None, "<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>"]
+    kids = []
+    for page in pages:
+        escaped = [line.replace('\\', '\\\\').replace('(', '\\(').replace(')', '\\)') for line in page]
+        stream = "BT /F1 10 Tf 14 TL 50 760 Td " + " ".join(f"({line}) '" for line in escaped) + " ET"
+        objects.append(f"<< /Length {len(stream.encode('latin-1', 'replace'))} >>\nstream\n{stream}\nendstream")
+        objects.append(f"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 792] /Resources << /Font << /F1 3 0 R >> >> /Contents {len(objects)} 0 R >>")
+        kids.append(f"{len(objects)} 0 R")
+    objects[1] = f"<< /Type /Pages /Kids [{' '.join(kids)}] /Count {len(kids)} >>"
+
+    output = bytearray(b"%PDF-1.4\n")
+    offsets = []
+    for number, body in enumerate(objects, 1):
+        offsets.append(len(output))
+        output += f"{number} 0 obj\n{body}\nendobj\n".encode('latin-1', 'replace')
+    xref = len(output)
+    output += f"xref\n0 {len(objects) + 1}\n0000000000 65535 f \n".encode()
+    output += "".join(f"{offset:010d} 00000 n \n" for offset in offsets).encode()
+    output += f"trailer\n<< /Size {len(objects) + 1} /Root 1 0 R >>\nstartxref\n{xref}\n%%EOF\n".encode()
+    with open(path, 'wb') as file:
+        file.write(output)
+
+
+def write_image(path, rng, width, height):
+    try:
+        from PIL import Image, ImageDraw
+    except ImportError:
+        Image = None
+    if Image is not None:
+        image = Image.new('RGB', (width, height), tuple(rng.randrange(256) for _ in range(3)))
+        draw = ImageDraw.Draw(image)
+        for _ in range(40):
+            x, y = rng.randrange(width), rng.randrange(height)
+            draw.ellipse((x, y, x + rng.randrange(width // 4 + 1), y + rng.randrange(height // 4 + 1)), fill=tuple(rng.randrange(256) for _ in range(3)))
+        image.save(path + '.jpg', quality=92)
+        return path + '.jpg'
+
+    # Without Pillow write a grayscale PNG by hand
+    def chunk(kind, data):
+        return struct.pack('>I', len(data)) + kind + data + struct.pack('>I', zlib.crc32(kind + data) & 0xffffffff)
+    rows = b"".join(b"\x00" + bytes(rng.randrange(256) for _ in range(width)) for _ in range(height))
+    with open(path + '.png', 'wb') as file:
+        file.write(b"\x89PNG\r\n\x1a\n" + chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 0, 0, 0, 0)) + chunk(b'IDAT', zlib.compress(rows)) + chunk(b'IEND', b''))
+    return path + '.png'
+
+
+def generate_corpus(directory, files=200, mix=(0.6, 0.2, 0.2), seed=1, duplicates=0.1):
+    rng = random.Random(seed)
+    os.makedirs(directory, exist_ok=True)
+    written = {'text': 0, 'pdf': 0, 'image': 0}
+    images = []
+    for index in range(files):
+        subdir = os.path.join(directory, f"dir{index % 10:02d}")
+        os.makedirs(subdir, exist_ok=True)
+        kind = rng.choices(['text', 'pdf', 'image'], weights=mix)[0]
+        base = os.path.join(subdir, f"file{index:06d}")
+        # Sizes are log-uniform so a few large files dominate, as on real shares
+        if kind == 'text':
+            with open(base + '.txt', 'w', encoding='utf-8') as file:
+                file.write(random_text(rng, int(10 ** rng.uniform(3, 5.5))))
+        elif kind == 'pdf':
+            write_pdf(base + '.pdf', random_text(rng, int(10 ** rng.uniform(3.3, 5))))
+        elif images and rng.random() < duplicates:
+            # Byte-identical copies exercise the content-hash cache
+            source = rng.choice(images)
+            with open(source, 'rb') as src, open(base + os.path.splitext(source)[1], 'wb') as dst:
+                dst.write(src.read())
+        else:
+            side = int(10 ** rng.uniform(2.4, 3.4))
+            images.append(write_image(base, rng, side, side * 3 // 4))
+        written[kind] += 1
+    print(f"Generated {files} files in {directory}: {written['text']} text, {written['pdf']} pdf, {written['image']} images")
+
+
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))]
+
+
+def run_scenario(name, extra_args, corpus, servers, workdir):
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'llm-utility.py')
+    # The child runs in the repository for its default config files, so paths from the command line are made absolute
+    corpus = os.path.abspath(corpus)
+    workdir = os.path.abspath(workdir)
+    output = os.path.join(workdir, f"{name}.json")
+    for path in (output, os.path.splitext(output)[0] + '.jsonl'):
+        if os.path.exists(path):
+            os.remove(path)
+    for server in servers:
+        server.reset()
+    # A fresh cache per run keeps runs cold while duplicate files still hit it, as in real use
+    command = [sys.executable, script, corpus, '--recursive', '--profile', '--output', output, '--cache-dir', os.path.join(workdir, f"{name}-cache"),
+               '--api-url', ",".join(server.url for server in servers), *extra_args]
+    log_path = os.path.join(workdir, f"{name}.log")
+    start = time.perf_counter()
+    with open(log_path, 'w', encoding='utf-8') as log:
+        process = subprocess.Popen(command, stdout=log, stderr=subprocess.STDOUT, cwd=os.path.dirname(script))
+        peak_rss = None
+        if hasattr(os, 'wait4'):
+            # ru_maxrss is in kilobytes on Linux and bytes on macOS
+            _, status, usage = os.wait4(process.pid, 0)
+            process.returncode = os.waitstatus_to_exitcode(status)
+            peak_rss = usage.ru_maxrss * (1 if sys.platform == 'darwin' else 1024)
+        else:
+            process.wait()
+    elapsed = time.perf_counter() - start
+
+    processed = 0
+    if os.path.exists(output):
+        with open(output, 'r', encoding='utf-8') as file:
+            processed = len(json.load(file))
+    stages = []
+    trace_path = os.path.splitext(output)[0] + '.trace.json'
+    if os.path.exists(trace_path):
+        with open(trace_path, 'r', encoding='utf-8') as file:
+            stages = json.load(file)['otherData']['summary']
+    counts = {}
+    latencies = {}
+    for server in servers:
+        for endpoint, count in server.counts.items():
+            counts[endpoint] = counts.get(endpoint, 0) + count
+            latencies.setdefault(endpoint, []).extend(server.latencies[endpoint])
+    return {
+        'scenario': name,
+        'args': extra_args,
+        'exit_code': process.returncode,
+        'files': processed,
+        'seconds': round(elapsed, 3),
+        'files_per_second': round(processed / elapsed, 3) if elapsed else 0,
+        'peak_rss_mb': round(peak_rss / 1024 / 1024, 1) if peak_rss else None,
+        'bytes_sent': sum(server.bytes_received for server in servers),
+        'requests': counts,
+        'stages': stages,
+        'latency': {endpoint: {'p50': round(percentile(values, 0.5), 4), 'p90': round(percentile(values, 0.9), 4), 'p99': round(percentile(values, 0.99), 4)}
+                    for endpoint, values in latencies.items()},
+        'log': log_path,
+    }
+
+
+def print_report(results, baseline=None):
+    previous = {result['scenario']: result for result in (baseline or [])}
+    for result in results:
+        rss = f"{result['peak_rss_mb']} MB" if result['peak_rss_mb'] is not None else "n/a"
+        line = f"\n{result['scenario']}: {result['files']} files in {result['seconds']}s, {result['files_per_second']} files/s, peak RSS {rss}, {result['bytes_sent'] // 1024} KB sent"
+        if result['scenario'] in previous and previous[result['scenario']]['files_per_second']:
+            change = result['files_per_second'] / previous[result['scenario']]['files_per_second'] - 1
+            line += f" ({change:+.1%} files/s vs baseline)"
+        print(line)
+        if result['exit_code']:
+            print(f"  exited with code {result['exit_code']}")
+        print(f"  {'endpoint':<34}{'calls':>7}{'p50':>9}{'p90':>9}{'p99':>9}")
+        for endpoint, count in sorted(result['requests'].items()):
+            latency = result['latency'][endpoint]
+            print(f"  {endpoint:<34}{count:>7}{latency['p50']:>9.3f}{latency['p90']:>9.3f}{latency['p99']:>9.3f}")
+        if result['stages']:
+            print(f"  {'stage':<34}{'calls':>7}{'p50':>9}{'p95':>9}{'total':>9}")
+            for stage in result['stages']:
+                print(f"  {stage['stage']:<34}{stage['calls']:>7}{stage['p50']:>9.3f}{stage['p95']:>9.3f}{stage['total']:>9.2f}")
+
+
+def parse_scenarios(names, scenario_file):
+    scenarios = dict(SCENARIOS)
+    if scenario_file:
+        with open(scenario_file, 'r', encoding='utf-8') as file:
+            scenarios.update(json.load(file))
+    missing = [name for name in names if name not in scenarios]
+    if missing:
+        raise SystemExit(f"Unknown scenario: {', '.join(missing)}. Available: {', '.join(scenarios)}")
+    return [(name, scenarios[name]) for name in names]
+
+
+def add_server_arguments(parser):
+    parser.add_argument('--context', type=int, default=8192, help='Context length the mock reports')
+    parser.add_argument('--prompt-rate', type=float, default=2000.0, help='Prompt processing speed in tokens per second')
+    parser.add_argument('--gen-rate', type=float, default=40.0, help='Generation speed in tokens per second')
+    parser.add_argument('--overhead', type=float, default=0.02, help='Fixed latency per generation in seconds')
+    parser.add_argument('--output-tokens', type=int, default=48, help='Tokens generated per request')
+    parser.add_argument('--caption-latency', type=float, default=0.3, help='Seconds per image caption')
+    parser.add_argument('--slots', type=int, default=1, help='Concurrent generations per mock backend')
+
+
+def make_servers(args, count, first_port=0):
+    return [MockKobold(port=first_port + index if first_port else 0, context=args.context, prompt_rate=args.prompt_rate, gen_rate=args.gen_rate,
+                       overhead=args.overhead, output_tokens=args.output_tokens, caption_latency=args.caption_latency, slots=args.slots).start()
+            for index in range(count)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark llm-utility.py against a local mock koboldcpp server.")
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    serve = commands.add_parser('serve', help='Run mock koboldcpp servers until interrupted')
+    serve.add_argument('--port', type=int, default=5001, help='Port of the first server')
+    serve.add_argument('--backends', type=int, default=1, help='Number of servers on consecutive ports')
+    add_server_arguments(serve)
+
+    corpus = commands.add_parser('corpus', help='Generate a synthetic corpus')
+    corpus.add_argument('directory', help='Directory to write the corpus to')
+    corpus.add_argument('--files', type=int, default=200, help='Number of files')
+    corpus.add_argument('--mix', type=float, nargs=3, default=[0.6, 0.2, 0.2], metavar=('TEXT', 'PDF', 'IMAGE'), help='Relative share of each file type')
+    corpus.add_argument('--seed', type=int, default=1, help='Random seed so corpora are reproducible')
+
+    run = commands.add_parser('run', help='Run benchmark scenarios and report throughput')
+    run.add_argument('--corpus', default=None, help='Corpus directory (generated in a temporary directory if omitted)')
+    run.add_argument('--files', type=int, default=200, help='Files to generate when no corpus is given')
+    run.add_argument('--scenarios', nargs='+', default=['sequential', 'pipelined'], help='Scenarios to run')
+    run.add_argument('--scenario-file', default=None, help='JSON file mapping extra scenario names to llm-utility.py arguments')
+    run.add_argument('--backends', type=int, default=1, help='Number of mock backends')
+    run.add_argument('--report', default=None, help='Write the results as JSON to this file')
+    run.add_argument('--baseline', default=None, help='Earlier --report file to compare against')
+    add_server_arguments(run)
+
+    args = parser.parse_args()
+
+    if args.command == 'corpus':
+        generate_corpus(args.directory, files=args.files, mix=args.mix, seed=args.seed)
+        return
+
+    if args.command == 'serve':
+        servers = make_servers(args, args.backends, first_port=args.port)
+        print("Mock koboldcpp listening on " + " ".join(server.url for server in servers))
+        try:
+            while True:
+                time.sleep(1)
+        except KeyboardInterrupt:
+            for server in servers:
+                server.stop()
+        return
+
+    scenarios = parse_scenarios(args.scenarios, args.scenario_file)
+    with tempfile.TemporaryDirectory(prefix='llm-benchmark-') as workdir:
+        corpus_dir = args.corpus
+        if corpus_dir is None:
+            corpus_dir = os.path.join(workdir, 'corpus')
+            generate_corpus(corpus_dir, files=args.files)
+        elif not os.path.isdir(corpus_dir):
+            generate_corpus(corpus_dir, files=args.files)
+
+        servers = make_servers(args, args.backends)
+        results = []
+        try:
+            for name, extra_args in scenarios:
+                print(f"Running {name}...", flush=True)
+                results.append(run_scenario(name, extra_args, corpus_dir, servers, workdir))
+        finally:
+            for server in servers:
+                server.stop()
+
+        baseline = None
+        if args.baseline:
+            with open(args.baseline, 'r', encoding='utf-8') as file:
+                baseline = json.load(file)
+        print_report(results, baseline)
+        # Logs live in the temporary directory, so keep a copy of any failed run's output
+        for result in results:
+            if (result['exit_code'] or not result['files']) and os.path.exists(result['log']):
+                with open(result['log'], 'r', encoding='utf-8', errors='replace') as log:
+                    print(f"\nLast lines of {result['scenario']}:\n" + "".join(log.readlines()[-20:]))
+        if args.report:
+            with open(args.report, 'w', encoding='utf-8') as file:
+                json.dump([{key: value for key, value in result.items() if key != 'log'} for result in results], file, indent=2)
+            print(f"\nReport written to {args.report}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,7 +1,13 @@
 import os
 import json
+import time
+import queue
+import random
 import argparse
-from llmprocessor import LLMProcessor, TaskProcessor, FileUtils, FileCrawler
+import multiprocessing
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from llmprocessor import LLMProcessor, TaskProcessor, FileUtils, FileCrawler, ResultCache, MetadataStore, FileManifest, FileScheduler, PerceptualIndex, MinHashIndex, DocumentExtractor, TextStream, ArchiveReader, profiler, enable_profiling, run_in_worker
 
 
 def normalize_keys(input_dict):
@@ -20,24 +26,34 @@ def normalize_keys(input_dict):
 
     return {normalize_key(k): process_value(v) for k, v in input_dict.items()}
 
-def extract_metadata(file_path, llm_processor, task_processor, category, caption=""):
-    tasks = ["metadata"]
+def print_progress(genkey, text):
+    lines = text.strip().splitlines()
+    last_line = lines[-1] if lines else ""
+    print(f"\r[{genkey}] {last_line[-100:]}".ljust(120), end="", flush=True)
+
+def extract_metadata(file_path, llm_processor, task_processor, category, caption="", document=None, content_hash=None, file_metadata=None, tasks=None, extractor=None):
+    tasks = tasks or ["metadata"]
     
-    if category == 'Document':
-        content = FileUtils.read_file_content(file_path)
-        init_result = FileUtils.clean_json(json.dumps(task_processor.process_tasks(file_path, content=content, tasks=tasks)))
+    if category == 'Document' and document is not None:
+        init_result = FileUtils.clean_json(json.dumps(task_processor.process_tasks(file_path, content=document['content'], tasks=tasks, sentences=document['sentences'], content_hash=content_hash)))
+
+    elif category == 'Document':
+        content = lambda: FileUtils.read_file_content(file_path, extractor)
+        init_result = FileUtils.clean_json(json.dumps(task_processor.process_tasks(file_path, content=content, tasks=tasks, content_hash=content_hash)))
         
     else:
-        init_result = FileUtils.clean_json(json.dumps(task_processor.process_tasks(file_path, content=FileUtils.clean_content(caption), tasks=tasks)))
+        init_result = FileUtils.clean_json(json.dumps(task_processor.process_tasks(file_path, content=FileUtils.clean_content(caption), tasks=tasks, content_hash=content_hash)))
         
 
     result = normalize_keys(init_result)
 
         
     
-    file_metadata = FileUtils.get_basic_metadata(file_path)
+    if file_metadata is None:
+        file_metadata = FileUtils.get_basic_metadata(file_path)
         
     llm_metadata = result.get('Metadata', {})
+    archive, _ = ArchiveReader.split(file_path)
   
 
     combined_metadata = {
@@ -56,80 +72,537 @@ def extract_metadata(file_path, llm_processor, task_processor, category, caption
         "Created": file_metadata['created'],
         "Modified": file_metadata['modified'],
         "Category": category,  
-        "ProposedFilename": llm_metadata.get("Filename", "unknown")  
+        "ProposedFilename": llm_metadata.get("Filename", "unknown"),
+        "DuplicateOf": "",
+        "Archive": os.path.abspath(archive) if archive else ""
     }
+
+    for task in tasks:
+        if task != "metadata" and task_processor.task_config.get(task, {}).get('write_result'):
+            combined_metadata[task.title()] = result.get(task.title(), "")
     
     return combined_metadata    
 
 
-def process_files(directory, llm_processor, task_processor, output_path, categories):
-    if os.path.exists(output_path):
-        with open(output_path, 'r') as f:
-            central_metadata = json.load(f)
-    else:
-        central_metadata = {}
+def process_file(file_path, category, llm_processor, task_processor, document=None, content_hash=None, file_metadata=None, tasks=None, extractor=None, duplicates=None):
+    if content_hash is None and task_processor.cache is not None:
+        content_hash = FileUtils.hash_file(file_path)
+    if category == 'image':
+        caption = task_processor.interrogate_image(file_path, content_hash=content_hash, image=document)
+        if not caption:
+            print(f"\nFailed to interrogate: {file_path}")
+            return None
+        return extract_metadata(file_path, llm_processor, task_processor, category="Image", caption=caption, content_hash=content_hash, file_metadata=file_metadata, tasks=tasks)
+
+    signature = None
+    if duplicates is not None:
+        # Fully cached files cost nothing, so only files headed for the LLM are extracted up front
+        if document is None and not task_processor.is_cached(content_hash, tasks or ["metadata"]):
+            document = FileUtils.extract_document(file_path, llm_processor.segmenter, extractor, minhash=True)
+        signature = document.get('minhash') if document is not None else None
+        match = duplicates.find(signature) if signature is not None else None
+        if match is not None:
+            return reuse_metadata(match[0], file_path, match[1], file_metadata)
+    metadata = extract_metadata(file_path, llm_processor, task_processor, category="Document", caption="", document=document, content_hash=content_hash, file_metadata=file_metadata, tasks=tasks, extractor=extractor)
+    if signature is not None and metadata is not None:
+        duplicates.add(signature, metadata)
+    return metadata
+
+
+def reuse_metadata(original, file_path, similarity, file_metadata=None):
+    # Versions and other formats of an already processed document share its LLM metadata
+    if file_metadata is None:
+        file_metadata = FileUtils.get_basic_metadata(file_path)
+    metadata = dict(original)
+    metadata.update({
+        "File": os.path.basename(file_path),
+        "FullPath": os.path.abspath(file_path),
+        "PreviousPath": "",
+        "PreviousName": "",
+        "Size (KB)": file_metadata['size'] // 1024,
+        "Created": file_metadata['created'],
+        "Modified": file_metadata['modified'],
+        # The renamer would otherwise move every version onto the same name
+        "ProposedFilename": f"{os.path.splitext(original['ProposedFilename'])[0]}_{os.path.splitext(os.path.basename(file_path))[0]}",
+        "DuplicateOf": original["FullPath"],
+        "Similarity": round(similarity, 3),
+    })
+    print(f"\nNear-duplicate ({similarity:.0%}) of {original['FullPath']}: {file_path}")
+    return metadata
+
+
+def move_metadata(file_path, file_info, content_hash, store, manifest):
+    # A vanished file with the same content means this one was moved or renamed
+    for old_path in manifest.find_by_hash(content_hash):
+        if old_path == file_path or FileUtils.path_exists(old_path):
+            continue
+        metadata = store.get(old_path)
+        if metadata is None:
+            continue
+        file_metadata = file_info['file_metadata']
+        metadata = dict(metadata)
+        metadata.update({
+            "File": os.path.basename(file_path),
+            "FullPath": file_path,
+            "PreviousPath": old_path,
+            "PreviousName": os.path.basename(old_path),
+            "Size (KB)": file_metadata['size'] // 1024,
+            "Created": file_metadata['created'],
+            "Modified": file_metadata['modified'],
+        })
+        store.remove(old_path)
+        store.put(metadata)
+        manifest.remove(old_path)
+        manifest.record(file_path, file_metadata, content_hash)
+        print(f"\nMoved: {old_path} -> {file_path}")
+        return True
+    return False
+
 
+def select_files(file_infos, store, manifest=None):
+    queued_paths = set()
+    skipped = 0
+    moved = 0
+    queued = 0
+    failed = 0
+    for file_info in file_infos:
+        category = file_info['category']
+        file_path = os.path.abspath(file_info['path'])
+        file_metadata = file_info['file_metadata']
+        if file_path in queued_paths:
+            continue
+        existing = store.get(file_path) if store is not None else None
+        if existing is not None:
+            if manifest is None or manifest.is_unchanged(file_path, file_metadata):
+                skipped += 1
+                continue
+            if manifest.get(file_path) is None and existing.get('Modified') == file_metadata['modified']:
+                # Results from runs before the manifest existed are adopted as they are
+                manifest.put(file_path, file_metadata['size'], file_metadata['modified'])
+                skipped += 1
+                continue
+        content_hash = None
+        if manifest is not None:
+            try:
+                content_hash = manifest.get_hash(file_path, file_metadata)
+                if existing is None and move_metadata(file_path, file_info, content_hash, store, manifest):
+                    moved += 1
+                    continue
+            except OSError as e:
+                # A file that vanished or cannot be read is left for the next run instead of ending this one
+                print(f"\nError reading {file_path}: {e}")
+                failed += 1
+                continue
+        queued_paths.add(file_path)
+        queued += 1
+        yield category, file_info, content_hash
+    print(f"\nCrawl finished: skipped {skipped} already processed files, detected {moved} moved files, queued {queued} files" + (f", could not read {failed} files" if failed else ""))
+
+
+def record_result(store, manifest, file_info, metadata, content_hash=None):
+    profiler.count('files')
+    store.put(metadata)
+    if manifest is not None:
+        manifest.record(metadata['FullPath'], file_info['file_metadata'], content_hash)
+
+
+def schedule_files(file_infos, store, manifest=None, scheduler=None, cache=None):
+    selected = select_files(file_infos, store, manifest)
+    if scheduler is None:
+        return ((0.0, item) for item in selected)
+    if cache is not None and scheduler.policy != 'fifo':
+        selected = hash_files(selected)
+    return scheduler.schedule(selected)
+
+
+def hash_files(selected):
+    # Cached files cost nothing, which the scheduler can only tell from their hash
+    for category, file_info, content_hash in selected:
+        if content_hash is None:
+            try:
+                content_hash = FileUtils.hash_file(file_info['path'])
+            except OSError as e:
+                print(f"\nError reading {file_info['path']}: {e}")
+                continue
+        yield category, file_info, content_hash
+
+
+def process_files(directory, llm_processor, task_processor, store, categories, recursive=False, manifest=None, crawl_workers=0, tasks=None, extractor=None, duplicates=None, archives=False, scheduler=None):
     file_crawler = FileCrawler()
-    file_list = file_crawler.crawl(directory, recursive=recursive, categories=categories)
-    
-    total_files = sum(len(files) for files in file_list.values())
-    processed_files = 0
+    file_infos = file_crawler.iter_files(directory, recursive=recursive, categories=categories, workers=crawl_workers, archives=archives)
 
-    for category, files in file_list.items():
-        for file_info in files:
-            file_path = file_info['path']
-            file_name = os.path.basename(file_path)
+    for processed_files, (cost, (category, file_info, content_hash)) in enumerate(schedule_files(file_infos, store, manifest, scheduler, task_processor.cache), 1):
+        file_path = file_info['path']
+        print(f"\rProcessing file {processed_files}: {file_path}", end="", flush=True)
+        
+        try:
+            start = time.perf_counter()
+            metadata = process_file(file_path, category, llm_processor, task_processor, content_hash=content_hash, file_metadata=file_info['file_metadata'], tasks=tasks, extractor=extractor, duplicates=duplicates)
+            if scheduler is not None:
+                scheduler.complete(cost, time.perf_counter() - start)
+            if metadata is None:
+                continue
             
-            if file_name not in central_metadata:
-                processed_files += 1
-                print(f"\rProcessing file {processed_files} of {total_files}: {file_path}", end="", flush=True)
-                
-                try:
-                    if category == 'image':
-                        caption = llm_processor.interrogate_image(file_path)
-                        if caption:
-                            metadata = extract_metadata(file_path, llm_processor, task_processor, category="Image", caption=caption)
-
-                        else:
-                            print(f"\nFailed to interrogate: {file_path}")
-                            continue
-                    else:
-                        metadata = extract_metadata(file_path, llm_processor, task_processor, category="Document", caption="")
-                    
-                    central_metadata[file_name] = metadata
-
-                    with open(output_path, 'w') as f:
-                        json.dump(central_metadata, f, indent=2)
-                except Exception as e:
-                    print(f"\nError processing {file_path}: {str(e)}")
-                    continue
-            else:
-                print(f"\nSkipped (already processed): {file_path}")
+            record_result(store, manifest, file_info, metadata, content_hash)
+        except Exception as e:
+            print(f"\nError processing {file_path}: {str(e)}")
+            continue
+
+
+def process_files_pipelined(directory, processors, store, categories, recursive=False, extract_workers=0, manifest=None, crawl_workers=0, tasks=None, extractor=None, duplicates=None, archives=False, scheduler=None):
+    file_crawler = FileCrawler()
+    file_infos = file_crawler.iter_files(directory, recursive=recursive, categories=categories, workers=crawl_workers, archives=archives)
+
+    # Bounded so extraction only runs a few files ahead of the inference workers
+    work_queue = queue.Queue(maxsize=len(processors) * 2)
+    task_processor = processors[0][1]
+    segmenter = processors[0][0].segmenter
+    image_size = processors[0][0].image_size
+    result_queue = queue.Queue()
+    executor = None
+    if extract_workers > 0:
+        # Spawned, not forked: by now this process runs the HTTP event loop and worker threads that may hold locks
+        executor = ProcessPoolExecutor(max_workers=extract_workers, mp_context=multiprocessing.get_context('spawn'), initializer=enable_profiling if profiler.enabled else None, initargs=(profiler.trace, True))
+
+    def feed():
+        queued = 0
+        try:
+            for cost, (category, file_info, content_hash) in schedule_files(file_infos, store, manifest, scheduler, task_processor.cache):
+                future = None
+                if content_hash is None and task_processor.cache is not None:
+                    try:
+                        content_hash = FileUtils.hash_file(file_info['path'])
+                    except OSError as e:
+                        # Skipped before it takes an index, so the merge below does not wait for it
+                        print(f"\nError reading {file_info['path']}: {e}")
+                        continue
+                # Cache hits skip the extraction pool entirely
+                if executor is None:
+                    pass
+                elif category == 'image':
+                    if not task_processor.is_caption_cached(content_hash):
+                        future = executor.submit(run_in_worker, FileUtils.prepare_image, file_info['path'], image_size)
+                elif not task_processor.is_cached(content_hash, tasks or ["metadata"]):
+                    future = executor.submit(run_in_worker, FileUtils.extract_document, file_info['path'], segmenter, extractor, duplicates is not None)
+                work_queue.put((queued, category, file_info, future, content_hash, cost))
+                queued += 1
+        finally:
+            for _ in processors:
+                work_queue.put(None)
+            result_queue.put((None, queued, None, None))
+
+    def infer(llm_processor, task_processor):
+        while True:
+            item = work_queue.get()
+            if item is None:
+                return
+            index, category, file_info, future, content_hash, cost = item
+            file_path = file_info['path']
+            metadata = None
+            try:
+                start = time.perf_counter()
+                document = None
+                if future is not None:
+                    document, profile = future.result()
+                    if profile is not None:
+                        profiler.merge(profile)
+                metadata = process_file(file_path, category, llm_processor, task_processor, document=document, content_hash=content_hash, file_metadata=file_info['file_metadata'], tasks=tasks, extractor=extractor, duplicates=duplicates)
+                if scheduler is not None:
+                    scheduler.complete(cost, time.perf_counter() - start)
+            except Exception as e:
+                print(f"\nError processing {file_path}: {str(e)}")
+            result_queue.put((index, file_info, metadata, content_hash))
+
+    threads = [threading.Thread(target=feed, daemon=True)]
+    threads.extend(threading.Thread(target=infer, args=pair, daemon=True) for pair in processors)
+    for thread in threads:
+        thread.start()
+
+    # Merge in dispatch order so the output does not depend on worker timing
+    completed = {}
+    next_index = 0
+    total_files = None
+    try:
+        while total_files is None or next_index < total_files:
+            index, file_info, metadata, content_hash = result_queue.get()
+            if index is None:
+                # The feeder reports how many files it queued once the crawl is done
+                total_files = file_info
+                continue
+            completed[index] = (file_info, metadata, content_hash)
+            print(f"\rProcessed file {len(completed) + next_index}: {file_info['path']}", end="", flush=True)
+            while next_index in completed:
+                file_info, metadata, content_hash = completed.pop(next_index)
+                if metadata is not None:
+                    record_result(store, manifest, file_info, metadata, content_hash)
+                next_index += 1
+    finally:
+        for thread in threads:
+            thread.join()
+        if executor is not None:
+            executor.shutdown()
+
+def format_duration(seconds):
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    days, hours = divmod(hours, 24)
+    if days:
+        return f"{days}d {hours}h {minutes:02d}m"
+    if hours:
+        return f"{hours}h {minutes:02d}m"
+    return f"{minutes}m {seconds:02d}s"
+
+def sample_extraction(paths, extractor, workers=4):
+    # Characters of cleaned text per byte of file, measured on a sample and applied to the rest by size
+    def measure(file_path):
+        start = time.perf_counter()
+        try:
+            with FileUtils.open_file(file_path) as file:
+                kind = extractor.sniff(file.read(extractor.sniff_bytes))
+            content = extractor.extract(file_path)['content']
+            size = min(FileUtils.file_size(file_path), extractor.max_bytes)
+            if isinstance(content, TextStream):
+                # Large text is measured on its first block
+                content = next(content.iter_text())
+                size = len(content.encode('utf-8', 'surrogatepass'))
+            content = FileUtils.clean_content(content)
+        except Exception as e:
+            print(f"\nError extracting {file_path}: {e}")
+            return None
+        return size, len(content), time.perf_counter() - start, kind, content[:8192]
+
+    # The first extraction pays for imports and starting tika, so it is not timed
+    measure(paths[0])
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        samples = [sample for sample in pool.map(measure, paths) if sample is not None and sample[0] > 0]
+    if not samples:
+        return None
+    size = sum(sample[0] for sample in samples)
+    kinds = {sample[3] for sample in samples}
+    kind = 'tika' if 'tika' in kinds else 'html' if 'html' in kinds else 'text'
+    return sum(sample[1] for sample in samples) / size, sum(sample[2] for sample in samples) / size, kind, [sample[4] for sample in samples if sample[4]]
+
+# Rough characters of text per byte by extension, to rank files before anything is extracted
+TEXT_PER_BYTE = {'txt': 1.0, 'md': 1.0, 'rtf': 0.5, 'html': 0.3, 'htm': 0.3, 'doc': 0.3, 'docx': 0.2, 'pdf': 0.1}
+
+def estimate_seconds(item, task_processor, tasks, rates, extractor, caption_tokens=64):
+    # Inference time on one backend, from the file size and the same counting as the plan
+    category, file_info, content_hash = item
+    tasks = tasks or ["metadata"]
+    if category == 'image':
+        if content_hash is not None and task_processor.is_caption_cached(content_hash):
+            return 0.0
+        tokens = caption_tokens
+        seconds = rates['caption']
+    else:
+        if content_hash is not None and task_processor.is_cached(content_hash, tasks):
+            return 0.0
+        size = file_info['file_metadata']['size']
+        extension = file_info['extension']
+        # HTML is cut at the byte limit, large text is streamed and other documents over it are skipped
+        if size > extractor.max_bytes:
+            if extension in ('html', 'htm'):
+                size = extractor.max_bytes
+            elif extension not in ('txt', 'md'):
+                return 0.0
+        tokens = int(size * TEXT_PER_BYTE.get(extension, 0.2) / task_processor.llm_processor.tokenizer.ratio())
+        seconds = 0.0
+    for calls, prompt_tokens, output_tokens in task_processor.plan_tasks(tokens, tasks, rates.get('output_fill', 1.0)).values():
+        seconds += calls * rates.get('overhead', 0) + prompt_tokens / rates['prompt'] + output_tokens / rates['generate']
+    return seconds
+
+def plan_files(directory, llm_processor, task_processor, store, categories, recursive=False, crawl_workers=0, tasks=None, extractor=None, sample=20, rates=None, caption_tokens=64, extract_workers=0, archives=False):
+    # Dry run: crawl and size the job from file sizes and a sampled extraction, without generating anything
+    tasks = tasks or ["metadata"]
+    rates = rates or {}
+    file_crawler = FileCrawler()
+    file_infos = file_crawler.iter_files(directory, recursive=recursive, categories=categories, workers=crawl_workers, archives=archives)
+
+    documents = {}
+    images = 0
+    total_bytes = 0
+    for category, file_info, _ in select_files(file_infos, store):
+        total_bytes += file_info['file_metadata']['size']
+        if category == 'image':
+            images += 1
+        else:
+            documents.setdefault(file_info['extension'], []).append((file_info['path'], file_info['file_metadata']['size']))
 
-    print(f"\nAll metadata saved to {output_path}")
+    print(f"Sampling extraction of up to {sample} files per extension...")
+    ratios = {}
+    for extension, files in documents.items():
+        paths = [file_path for file_path, _ in random.sample(files, min(sample, len(files)))]
+        ratios[extension] = sample_extraction(paths, extractor, workers=max(4, 2 * len(extractor.tika_endpoints)))
+        if ratios[extension] is None:
+            print(f"Could not extract any sampled .{extension} file; counting them as empty")
+
+    totals = {}
+    def add(name, plan):
+        totals[name] = [a + b for a, b in zip(totals.get(name, [0, 0, 0]), plan)]
+
+    # The backend tokenizer is cheap to ask and calibrates the characters per token for the estimates below
+    texts = [text for ratio in ratios.values() if ratio is not None for text in ratio[3]]
+    if texts:
+        llm_processor.tokenizer.count_many(texts)
+    chars_per_token = llm_processor.tokenizer.ratio()
+    content_tokens = 0
+    extraction_seconds = 0
+    for extension, files in documents.items():
+        if ratios[extension] is None:
+            continue
+        chars_per_byte, seconds_per_byte, kind, _ = ratios[extension]
+        for _, size in files:
+            # Files for tika are skipped over the byte limit, HTML is cut at it and large text is streamed whole
+            if size > extractor.max_bytes and kind == 'tika':
+                continue
+            if kind != 'text' or size <= extractor.stream_bytes:
+                size = min(size, extractor.max_bytes)
+            tokens = int(size * chars_per_byte / chars_per_token)
+            content_tokens += tokens
+            extraction_seconds += size * seconds_per_byte
+            for name, plan in task_processor.plan_tasks(tokens, tasks, rates.get('output_fill', 1.0)).items():
+                add(name, plan)
+    if images:
+        add('caption', (images, 0, 0))
+        for name, plan in task_processor.plan_tasks(caption_tokens, tasks, rates.get('output_fill', 1.0)).items():
+            add(name, [value * images for value in plan])
+
+    document_count = sum(len(files) for files in documents.values())
+    print(f"\nPlan for {document_count + images} files ({document_count} documents, {images} images, {total_bytes / 1024 ** 2:.1f} MB)")
+    print(f"Estimated {content_tokens} tokens of document text at {chars_per_token:.2f} characters per token, context {llm_processor.max_context_length}")
+    print(f"{'Task':<24}{'Calls':>10}{'Prompt tokens':>16}{'Output tokens':>16}")
+    for name, (calls, prompt_tokens, output_tokens) in totals.items():
+        print(f"{name:<24}{calls:>10}{prompt_tokens:>16}{output_tokens:>16}")
+    calls, prompt_tokens, output_tokens = [sum(plan[i] for name, plan in totals.items() if name != 'caption') for i in range(3)]
+    print(f"{'Total':<24}{calls + images:>10}{prompt_tokens:>16}{output_tokens:>16}")
+    print(f"Output tokens assume answers use {rates.get('output_fill', 1.0):.0%} of the max_length sent with each request (see --output-fill)")
+
+    # Each koboldcpp backend runs one generation at a time, so the work divides over the backends
+    inference_seconds = (calls * rates.get('overhead', 0) + prompt_tokens / rates['prompt'] +
+                         output_tokens / rates['generate'] + images * rates['caption'])
+    print(f"\nThroughput per backend ({rates.get('source', 'arguments')}): {rates['prompt']:.0f} prompt tokens/s, "
+          f"{rates['generate']:.1f} generated tokens/s, {rates['caption']:.2f}s per caption")
+    print(f"Extraction: about {format_duration(extraction_seconds)} of work ({extract_workers or 'no'} extraction processes)")
+    backend_counts = sorted({1, 2, 4, 8, len(llm_processor.backends)})
+    for count in backend_counts:
+        if extract_workers > 0:
+            wall = max(inference_seconds / count, extraction_seconds / extract_workers)
+        else:
+            wall = (inference_seconds + extraction_seconds) / count
+        marker = " (configured)" if count == len(llm_processor.backends) else ""
+        print(f"  {count:>3} backend{'s' if count > 1 else ' '}: {format_duration(wall)}{marker}")
+    return totals
+
+def category_weights(value):
+    weights = []
+    for entry in value.split(','):
+        category, _, weight = entry.strip().partition('=')
+        try:
+            weight = float(weight)
+        except ValueError:
+            weight = 0
+        if category not in ('document', 'image') or weight <= 0:
+            raise argparse.ArgumentTypeError(f"expected document=WEIGHT or image=WEIGHT with a positive weight, got '{entry}'")
+        weights.append((category, weight))
+    return weights
+
+def positive_minutes(value):
+    try:
+        minutes = float(value)
+    except ValueError:
+        minutes = 0
+    if minutes <= 0:
+        raise argparse.ArgumentTypeError(f"expected a positive number of minutes, got '{value}'")
+    return minutes
+
+def planning_rates(args, llm_processor):
+    llm_processor.load_template()
+    llm_processor.max_context_length = args.context_length or llm_processor.get_max_context()
+    if not llm_processor.max_context_length:
+        print("Could not read the context length from the backends; planning with 4096 (see --context-length)")
+        llm_processor.max_context_length = 4096
+    measured = None if args.prompt_rate and args.gen_rate else llm_processor.get_throughput()
+    return {
+        'prompt': args.prompt_rate or (measured[0] if measured else 1000.0),
+        'generate': args.gen_rate or (measured[1] if measured else 30.0),
+        'caption': args.caption_seconds,
+        'overhead': args.request_overhead,
+        'output_fill': args.output_fill,
+        'source': 'arguments' if args.prompt_rate and args.gen_rate else 'last generation on the backends' if measured else 'defaults',
+    }
 
 def main():
     parser = argparse.ArgumentParser(description="Extract metadata from documents and images using LLM.")
     parser.add_argument("directory", help="Directory containing the files")
-    parser.add_argument("--api-url", required=True, default="http://localhost:5001/api", help="URL for the LLM API")
+    parser.add_argument("--api-url", action='append', default=None, help="URL for the LLM API (default: http://localhost:5001/api); repeat the flag or separate URLs with commas to balance across backends")
     parser.add_argument("--api-password", default="", help="Password for the LLM API")
     parser.add_argument("--task-config", default="query_config.json", help="Path to the task configuration file")
     parser.add_argument("--output", default="file_metadata.json", help="Output path for the central metadata JSON")
+    parser.add_argument("--store", choices=['jsonl', 'sqlite'], default='jsonl', help="Working metadata store; the output JSON is exported from it at the end of the run")
+    parser.add_argument("--store-path", default=None, help="Path of the metadata store (default: output path with .jsonl or .db extension)")
+    parser.add_argument("--incremental", action='store_true', help="Reprocess new and changed files and detect moved files using a size/mtime/hash manifest")
     parser.add_argument("--model-name", default="phi3", help="LLM model name")
     parser.add_argument("--prompt-config", default="prompt_config.json")
     parser.add_argument('--recursive', action='store_true', help='Crawl directory tree')
     parser.add_argument('--categories', choices=['images', 'documents', 'all'], default='all', help='File categories to process')
+    parser.add_argument('--cache-dir', default=None, help='Directory for the result cache (default: .llm_cache next to the output file)')
+    parser.add_argument('--cache-size', type=int, default=512, help='Maximum result cache size in MB')
+    parser.add_argument('--no-cache', action='store_true', help='Always query the LLM, even for files seen before')
+    parser.add_argument('--stream', action='store_true', help='Read generations from the SSE stream endpoint instead of waiting for the full response')
+    parser.add_argument('--live', action='store_true', help='Show generated text as it arrives')
+    parser.add_argument('--segmenter', choices=['spacy', 'regex', 'pysbd'], default='spacy', help='Sentence splitter used for chunking; regex is much faster on large bulk runs')
+    parser.add_argument('--crawl-workers', type=int, default=0, help='Threads used to scan subdirectories ahead of processing')
+    parser.add_argument('--workers', type=int, default=None, help='Number of concurrent inference workers (default: one per backend)')
+    parser.add_argument('--extract-workers', type=int, default=0, help='Processes for document extraction, sentence splitting and image resizing (0 does this inside the inference workers)')
+    parser.add_argument('--tasks', nargs='+', default=['metadata'], help='Tasks from the task config to run on each file; results of tasks other than metadata are stored under their own key')
+    parser.add_argument('--fuse-tasks', action='store_true', help='Answer compatible tasks with one request per chunk instead of one per task')
+    parser.add_argument('--max-bytes', type=int, default=32 * 1024 * 1024, help='Read at most this many bytes of an HTML file and skip larger binary documents')
+    parser.add_argument('--large-text-bytes', type=int, default=4 * 1024 * 1024, help='Text files over this size are read a block at a time, and only as far as the chunks a task needs')
+    parser.add_argument('--tika-servers', type=int, default=1, help='Local tika servers to start for parsing PDF and office files in parallel')
+    parser.add_argument('--tika-url', action='append', default=None, help='Use an already running tika server instead of starting local ones; repeat the flag or separate URLs with commas for several')
+    parser.add_argument('--image-size', type=int, default=768, help='Longest side in pixels images are scaled down to before captioning')
+    parser.add_argument('--phash-distance', type=int, default=6, help='Reuse the caption of an image whose perceptual hash differs by at most this many bits (-1 disables)')
+    parser.add_argument('--profile', action='store_true', help='Print time spent per stage at the end and write a Chrome trace next to the output')
+    parser.add_argument('--stats-interval', type=float, default=0, help='Print a progress line with throughput and request counts every N seconds')
+    parser.add_argument('--map-workers', type=int, default=None, help='Concurrent chunk requests per file for map_reduce tasks (default: two per backend)')
+    parser.add_argument('--archives', action='store_true', help='Process the documents and images inside zip, tar and gz archives without unpacking them (rar and 7z need rarfile and py7zr)')
+    parser.add_argument('--duplicate-threshold', type=float, default=0, help='Reuse the metadata of an already processed document whose text is at least this similar, e.g. 0.9 (MinHash estimate of shingle overlap; 0, the default, disables)')
+    parser.add_argument('--plan', action='store_true', help='Estimate API calls, tokens and wall time for the crawl without generating anything')
+    parser.add_argument('--plan-sample', type=int, default=20, help='Documents per file extension extracted to estimate text size when planning')
+    parser.add_argument('--prompt-rate', type=float, default=None, help='Prompt tokens per second per backend for planning and scheduling (default: read from the backends, else 1000)')
+    parser.add_argument('--gen-rate', type=float, default=None, help='Generated tokens per second per backend for planning and scheduling (default: read from the backends, else 30)')
+    parser.add_argument('--caption-seconds', type=float, default=0.5, help='Seconds per image caption for planning')
+    parser.add_argument('--request-overhead', type=float, default=0.05, help='Fixed seconds per request for planning')
+    parser.add_argument('--output-fill', type=float, default=1.0, help='Share of max_length answers are expected to use, for planning')
+    parser.add_argument('--caption-tokens', type=int, default=64, help='Tokens per image caption the tasks are planned on')
+    parser.add_argument('--context-length', type=int, default=None, help='Context length to plan with (default: ask the backends, else 4096)')
+    parser.add_argument('--schedule', choices=FileScheduler.policies, default='fifo', help='Order files are processed in: crawl order, shortest estimated job first, fair shares per category, or most value per second within --time-budget')
+    parser.add_argument('--schedule-window', type=int, default=1000, help='Files read ahead of processing for the scheduler to choose from')
+    parser.add_argument('--category-weights', action='append', type=category_weights, default=None, help='Weights such as document=2,image=1 for the fair and deadline schedules')
+    parser.add_argument('--time-budget', type=positive_minutes, default=None, help='Stop starting new files after this many minutes; files in flight finish and the rest are left for the next run')
     
     args = parser.parse_args()
     
+    if args.profile or args.stats_interval:
+        enable_profiling(trace=args.profile)
+    stats_stop = threading.Event()
+    if args.stats_interval:
+        def report_stats():
+            while not stats_stop.wait(args.stats_interval):
+                print(f"\n{profiler.stats_line()}", flush=True)
+        threading.Thread(target=report_stats, daemon=True).start()
     
-    llm_processor = LLMProcessor(api_url=args.api_url, password=args.api_password, model=args.model_name, prompt_config=args.prompt_config)
-    task_processor = TaskProcessor(llm_processor, args.task_config)
-    global recursive
-    if args.recursive:
-        recursive = True
-    else:
-        recursive = False
+    cache = None
+    if not args.no_cache and not args.plan:
+        cache_dir = args.cache_dir or os.path.join(os.path.dirname(os.path.abspath(args.output)), '.llm_cache')
+        cache = ResultCache(cache_dir, max_bytes=args.cache_size * 1024 * 1024)
+
+    progress_callback = print_progress if args.live else None
+    llm_processor = LLMProcessor(api_url=args.api_url or ["http://localhost:5001/api"], password=args.api_password, model=args.model_name, prompt_config=args.prompt_config, segmenter=args.segmenter, stream=args.stream, progress_callback=progress_callback, map_workers=args.map_workers, image_size=args.image_size)
+    # One index for all workers so near-duplicates are found whichever worker captioned the first image
+    image_index = PerceptualIndex(args.phash_distance) if args.phash_distance >= 0 else None
+    task_processor = TaskProcessor(llm_processor, args.task_config, cache=cache, fuse=args.fuse_tasks, image_index=image_index)
+    duplicates = MinHashIndex(args.duplicate_threshold) if args.duplicate_threshold > 0 else None
         
     categories = []
     if args.categories == 'all':
@@ -139,7 +612,64 @@ def main():
     elif args.categories == 'images':
         categories = ['image']
 
-    process_files(args.directory, llm_processor, task_processor, args.output, categories)
+    tika_urls = [url.strip() for entry in args.tika_url or [] for url in entry.split(',') if url.strip()]
+    extractor = DocumentExtractor(tika_endpoints=tika_urls or DocumentExtractor.local_endpoints(args.tika_servers), max_bytes=args.max_bytes, stream_bytes=args.large_text_bytes)
+    if 'document' in categories and args.tika_servers > 1 and not tika_urls:
+        extractor.warm_up()
+
+    workers = args.workers or len(llm_processor.backends)
+    store_path = args.store_path or os.path.splitext(args.output)[0] + ('.db' if args.store == 'sqlite' else '.jsonl')
+
+    if args.plan:
+        # Files already in the store are left out, as a real run would skip them
+        store = None
+        if os.path.exists(store_path) or os.path.exists(args.output):
+            store = MetadataStore.open(args.store, store_path)
+            store.sync_from_json(args.output)
+        rates = planning_rates(args, llm_processor)
+        try:
+            plan_files(args.directory, llm_processor, task_processor, store, categories, recursive=args.recursive, crawl_workers=args.crawl_workers, tasks=args.tasks, extractor=extractor, sample=args.plan_sample, rates=rates, caption_tokens=args.caption_tokens, extract_workers=args.extract_workers, archives=args.archives)
+        finally:
+            llm_processor.backends.close()
+            if store is not None:
+                store.close()
+        return
+
+    store = MetadataStore.open(args.store, store_path)
+    store.sync_from_json(args.output)
+    manifest = FileManifest(os.path.splitext(store_path)[0] + '.manifest.db') if args.incremental else None
+
+    scheduler = None
+    if args.schedule != 'fifo' or args.time_budget is not None:
+        estimate = None
+        if args.schedule != 'fifo':
+            rates = planning_rates(args, llm_processor)
+            estimate = lambda item: estimate_seconds(item, task_processor, args.tasks, rates, extractor, args.caption_tokens)
+        weights = dict(weight for entry in args.category_weights or [] for weight in entry)
+        scheduler = FileScheduler(args.schedule, estimate=estimate, weights=weights, window=args.schedule_window, time_budget=args.time_budget * 60 if args.time_budget is not None else None)
+
+    try:
+        if workers > 1 or args.extract_workers > 0:
+            processors = [(llm_processor, task_processor)]
+            for _ in range(workers - 1):
+                worker_llm = LLMProcessor(api_url=llm_processor.backends, password=args.api_password, model=args.model_name, prompt_config=args.prompt_config, tokenizer=llm_processor.tokenizer, segmenter=args.segmenter, stream=args.stream, progress_callback=progress_callback, map_workers=args.map_workers, image_size=args.image_size)
+                processors.append((worker_llm, TaskProcessor(worker_llm, args.task_config, cache=cache, fuse=args.fuse_tasks, image_index=image_index)))
+            process_files_pipelined(args.directory, processors, store, categories, recursive=args.recursive, extract_workers=args.extract_workers, manifest=manifest, crawl_workers=args.crawl_workers, tasks=args.tasks, extractor=extractor, duplicates=duplicates, archives=args.archives, scheduler=scheduler)
+        else:
+            process_files(args.directory, llm_processor, task_processor, store, categories, recursive=args.recursive, manifest=manifest, crawl_workers=args.crawl_workers, tasks=args.tasks, extractor=extractor, duplicates=duplicates, archives=args.archives, scheduler=scheduler)
+    finally:
+        llm_processor.backends.close()
+        store.export_json(args.output)
+        store.close()
+        if manifest is not None:
+            manifest.close()
+        print(f"\nAll metadata saved to {args.output}")
+        stats_stop.set()
+        if args.profile:
+            profiler.print_summary()
+            trace_path = os.path.splitext(args.output)[0] + '.trace.json'
+            profiler.write_trace(trace_path)
+            print(f"Trace written to {trace_path}")
 
 if __name__ == "__main__":
     main()
@@ -1,19 +1,36 @@
 import os
 import re
-import ftfy
-import requests
+import asyncio
 import random
 import time
 import threading
 import json
+import hashlib
+import functools
+import itertools
+import heapq
+import sqlite3
 from datetime import datetime
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, Future
+import io
+import codecs
 import shutil
-from spacy.lang.en import English
 import base64
-from tika import parser
-from json_repair import repair_json
+import zipfile
+import tarfile
+import gzip
+from types import SimpleNamespace
+from contextlib import contextmanager
+from html.parser import HTMLParser
 from natsort import os_sorted
 
+# spaCy, tika, ftfy, json_repair, rarfile and py7zr are imported on first use to keep start-up fast
+_nlp = None
+_pysbd_segmenter = None
+_pillow_warned = False
+_sentence_pattern = re.compile(r'\S.*?(?:[.!?]+["\'\)\]]*(?=\s|$)|(?=\n)|$)', re.DOTALL)
+
 '''
 To do:
 
@@ -24,15 +41,182 @@ check if document is in english
 
 '''
 
+class NullSpan:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+class Span:
+    __slots__ = ('profiler', 'name', 'args', 'start')
+
+    def __init__(self, profiler, name, args):
+        self.profiler = profiler
+        self.name = name
+        self.args = args
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.profiler.record(self.name, self.start, time.perf_counter(), self.args)
+        return False
+
+class Profiler:
+    # Disabled, span() hands out one shared no-op context so instrumented code costs a method call
+    null_span = NullSpan()
+
+    def __init__(self, max_events=500000):
+        self.enabled = False
+        self.trace = False
+        self.worker = False
+        self.max_events = max_events
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.origin = time.perf_counter()
+        self.durations = {}
+        self.counters = {}
+        self.events = []
+        self.dropped = 0
+
+    def enable(self, trace=False, worker=False):
+        self.enabled = True
+        self.trace = self.trace or trace
+        self.worker = worker
+
+    def span(self, name, **args):
+        if not self.enabled:
+            return self.null_span
+        return Span(self, name, args)
+
+    def count(self, name, value=1):
+        if self.enabled:
+            with self.lock:
+                self.counters[name] = self.counters.get(name, 0) + value
+
+    def record(self, name, start, end, args):
+        with self.lock:
+            self.durations.setdefault(name, []).append(end - start)
+            if not self.trace:
+                return
+            if len(self.events) < self.max_events:
+                self.events.append((name, start, end, os.getpid(), threading.get_ident(), args))
+            else:
+                self.dropped += 1
+
+    def drain(self):
+        # Extraction processes hand what they recorded to the parent along with each result
+        with self.lock:
+            data = {'durations': self.durations, 'counters': self.counters, 'events': self.events}
+            self.durations, self.counters, self.events = {}, {}, []
+        return data
+
+    def merge(self, data):
+        with self.lock:
+            for name, values in data['durations'].items():
+                self.durations.setdefault(name, []).extend(values)
+            for name, value in data['counters'].items():
+                self.counters[name] = self.counters.get(name, 0) + value
+            room = max(0, self.max_events - len(self.events))
+            self.events.extend(data['events'][:room])
+            self.dropped += max(0, len(data['events']) - room)
+
+    def summary(self):
+        rows = []
+        with self.lock:
+            durations = {name: sorted(values) for name, values in self.durations.items()}
+        for name, values in sorted(durations.items(), key=lambda item: -sum(item[1])):
+            total = sum(values)
+            rows.append({
+                'stage': name,
+                'calls': len(values),
+                'total': round(total, 4),
+                'mean': round(total / len(values), 4),
+                'p50': round(values[len(values) // 2], 4),
+                'p95': round(values[min(len(values) - 1, int(len(values) * 0.95))], 4),
+                'max': round(values[-1], 4),
+            })
+        return rows
+
+    def print_summary(self):
+        elapsed = time.perf_counter() - self.origin
+        print(f"\nProfile after {elapsed:.1f}s (stage times overlap when work runs in parallel)")
+        print(f"{'stage':<22}{'calls':>8}{'total s':>10}{'mean ms':>10}{'p50 ms':>10}{'p95 ms':>10}{'max ms':>10}")
+        for row in self.summary():
+            print(f"{row['stage']:<22}{row['calls']:>8}{row['total']:>10.2f}{row['mean'] * 1000:>10.1f}"
+                  f"{row['p50'] * 1000:>10.1f}{row['p95'] * 1000:>10.1f}{row['max'] * 1000:>10.1f}")
+        for name, value in sorted(self.counters.items()):
+            print(f"{name:<40}{value:>12}")
+
+    def stats_line(self):
+        elapsed = time.perf_counter() - self.origin
+        with self.lock:
+            counters = dict(self.counters)
+        files = counters.get('files', 0)
+        requests = sum(value for name, value in counters.items() if name.startswith('requests '))
+        sent = counters.get('bytes sent', 0) / 1024 / 1024
+        return f"[{elapsed:.0f}s] {files} files ({files / elapsed if elapsed else 0:.2f}/s), {requests} requests, {sent:.1f} MB sent"
+
+    def write_trace(self, path):
+        # Chrome trace format; open in chrome://tracing or https://ui.perfetto.dev
+        with self.lock:
+            events = [{
+                'name': name,
+                'ph': 'X',
+                'ts': round((start - self.origin) * 1e6, 1),
+                'dur': round((end - start) * 1e6, 1),
+                'pid': pid,
+                'tid': tid,
+                'args': args,
+            } for name, start, end, pid, tid, args in self.events]
+            counters = dict(self.counters)
+            dropped = self.dropped
+        trace = {
+            'traceEvents': events,
+            'displayTimeUnit': 'ms',
+            'otherData': {'summary': self.summary(), 'counters': counters, 'dropped_events': dropped},
+        }
+        with open(path, 'w', encoding='utf-8') as file:
+            json.dump(trace, file)
+
+profiler = Profiler()
+
+def enable_profiling(trace=False, worker=False):
+    # Module level so it can be the initializer of the extraction processes
+    if worker:
+        # A forked process starts with a copy of what the parent had recorded, which the parent already has
+        profiler.reset()
+    profiler.enable(trace=trace, worker=worker)
+
+def run_in_worker(function, *args):
+    # Extraction processes return what they recorded with each result so the parent can merge it
+    result = function(*args)
+    return result, profiler.drain() if profiler.worker else None
+
+def profiled(name):
+    def decorate(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not profiler.enabled:
+                return function(*args, **kwargs)
+            with Span(profiler, name, {}):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorate
+
 class FileUtils:
     @staticmethod
-    def get_basic_metadata(file_path):    
-        created = os.path.getctime(file_path)
-        modified = os.path.getmtime(file_path)
+    def get_basic_metadata(file_path, stat_result=None):    
+        if stat_result is None:
+            stat_result = os.stat(file_path)
         return {
-            'size': os.path.getsize(file_path),
-            'created': datetime.fromtimestamp(created).isoformat(),
-            'modified': datetime.fromtimestamp(modified).isoformat()
+            'size': stat_result.st_size,
+            'created': datetime.fromtimestamp(stat_result.st_ctime).isoformat(),
+            'modified': datetime.fromtimestamp(stat_result.st_mtime).isoformat()
         }
 
     @staticmethod
@@ -50,7 +234,15 @@ class FileUtils:
         if data is None:
             return ""
         if isinstance(data, dict):
-            data = json.dumps(data)
+            return data
+        # Grammar-constrained output is already valid JSON; repair is only the fallback
+        if data.lstrip().startswith('{'):
+            try:
+                parsed = json.loads(data)
+                if isinstance(parsed, dict):
+                    return parsed
+            except json.JSONDecodeError:
+                pass
             
         pattern = r'```json\s*(.*?)\s*```'
         match = re.search(pattern, data, re.DOTALL)
@@ -62,11 +254,13 @@ class FileUtils:
             if json_str:
                 json_str = json_str.group(0)
             else:
+                import ftfy
                 return ftfy.fix_text(data)
         
         json_str = re.sub(r'\n', ' ', json_str)
         json_str = re.sub(r'["""]', '"', json_str)
         try:
+            from json_repair import repair_json
             return json.loads(repair_json(json_str))
         except json.JSONDecodeError:
             if isinstance(data, dict):
@@ -75,18 +269,16 @@ class FileUtils:
                 return {data}
         
     @staticmethod
-    def read_file_content(file_path):
-        try:
-            with open(file_path, 'r', encoding='utf-8') as file:
-                return file.read()
-        except UnicodeDecodeError:
-            return (FileUtils.parse_with_tika(file_path)).get('content')
+    def read_file_content(file_path, extractor=None):
+        return (extractor or DocumentExtractor()).extract(file_path)['content']
+
     @staticmethod
-    def read_file_metadata(file_path):
-        return (FileUtils.parse_with_tika(file_path)).get('metadata')
+    def read_file_metadata(file_path, extractor=None):
+        return (extractor or DocumentExtractor()).extract(file_path)['metadata']
 
     @staticmethod
     def parse_with_tika(file_path):
+        from tika import parser
         parsed = parser.from_file(file_path)
         return parsed
 
@@ -123,18 +315,576 @@ class FileUtils:
             print(f"JSON error: {file_path}")
             return None     
     @staticmethod
-    def clean_content(content):
+    @profiled('clean')
+    def clean_content(content, strip=True):
         if content is None:
             return ""
+        import ftfy
         content = ftfy.fix_text(content)
         content = re.sub(r'\n+', '\n', content)
         content = re.sub(r' +', ' ', content)
-        return content.strip()
+        return content.strip() if strip else content
+
+    @staticmethod
+    @profiled('hash')
+    def hash_file(file_path, block_size=1024 * 1024):
+        archive, member = ArchiveReader.split(file_path)
+        if archive is not None:
+            # Members are keyed on the archive's hash and their path in it, so nothing is decompressed to hash them
+            return hashlib.sha256(f"{ArchiveReader.archive_hash(archive)}!{member}".encode('utf-8', 'surrogatepass')).hexdigest()
+        digest = hashlib.sha256()
+        with open(file_path, 'rb') as file:
+            for block in iter(lambda: file.read(block_size), b''):
+                digest.update(block)
+        return digest.hexdigest()
+
+    @staticmethod
+    def open_file(file_path):
+        archive, member = ArchiveReader.split(file_path)
+        if archive is not None:
+            return ArchiveReader.open(archive, member)
+        return open(file_path, 'rb')
+
+    @staticmethod
+    def file_size(file_path):
+        archive, member = ArchiveReader.split(file_path)
+        if archive is not None:
+            return ArchiveReader.member_size(archive, member)
+        return os.path.getsize(file_path)
+
+    @staticmethod
+    def path_exists(file_path):
+        archive, _ = ArchiveReader.split(file_path)
+        return os.path.exists(archive or file_path)
+
+    @staticmethod
+    def iter_sentences(content, segmenter='spacy'):
+        global _nlp, _pysbd_segmenter
+        if segmenter == 'pysbd':
+            try:
+                import pysbd
+            except ImportError:
+                print("pysbd is not installed, using the regex segmenter")
+                segmenter = 'regex'
+            else:
+                if _pysbd_segmenter is None:
+                    _pysbd_segmenter = pysbd.Segmenter(language="en", clean=False)
+                return iter(_pysbd_segmenter.segment(content))
+        if segmenter == 'regex':
+            return (match.group(0).strip() for match in _sentence_pattern.finditer(content))
+        if _nlp is None:
+            from spacy.lang.en import English
+            _nlp = English()
+            _nlp.add_pipe('sentencizer')
+        _nlp.max_length = max(_nlp.max_length, len(content) + 1)
+        return (str(sent) for sent in _nlp(content).sents)
+
+    @staticmethod
+    @profiled('segment')
+    def split_sentences(content, segmenter='spacy'):
+        return list(FileUtils.iter_sentences(content, segmenter))
+
+    @staticmethod
+    @profiled('image.prepare')
+    def prepare_image(image_path, max_size=768, quality=90):
+        # Runs in the extraction pool: downscale before upload and fingerprint for near-duplicate reuse
+        global _pillow_warned
+        try:
+            from PIL import Image, ImageOps
+        except ImportError:
+            Image = None
+            if not _pillow_warned:
+                print("Pillow is not installed, images are sent at full size")
+                _pillow_warned = True
+        with FileUtils.open_file(image_path) as image_file:
+            data = image_file.read()
+        if Image is not None:
+            try:
+                with Image.open(io.BytesIO(data)) as image:
+                    # JPEG can be decoded at 1/2 to 1/8 scale, far cheaper than a full decode
+                    image.draft('RGB', (max_size, max_size))
+                    image = ImageOps.exif_transpose(image).convert('RGB')
+                phash = FileUtils.difference_hash(image)
+                image.thumbnail((max_size, max_size))
+                buffer = io.BytesIO()
+                image.save(buffer, format='JPEG', quality=quality)
+                return {'image': base64.b64encode(buffer.getvalue()).decode('utf-8'), 'phash': phash}
+            except Exception as e:
+                print(f"Could not resize {image_path}, sending it as is: {e}")
+        return {'image': base64.b64encode(data).decode('utf-8'), 'phash': None}
+
+    @staticmethod
+    def difference_hash(image, size=8):
+        from PIL import Image
+        pixels = list(image.convert('L').resize((size + 1, size), Image.LANCZOS).getdata())
+        bits = 0
+        for row in range(size):
+            for col in range(size):
+                left = pixels[row * (size + 1) + col]
+                right = pixels[row * (size + 1) + col + 1]
+                bits = (bits << 1) | (left > right)
+        return f"{bits:0{size * size // 4}x}"
+
+    @staticmethod
+    @profiled('minhash')
+    def minhash(content, bins=64, shingle_size=4, min_shingles=20):
+        # One-permutation MinHash: each word shingle is hashed once and kept if it is the smallest in its bin.
+        # Word shingles survive the layout differences between a .docx and its PDF export
+        words = re.findall(r'\w+', content.lower())
+        if len(words) - shingle_size + 1 < max(1, min_shingles):
+            return None
+        signature = [None] * bins
+        for i in range(len(words) - shingle_size + 1):
+            digest = hashlib.blake2b(" ".join(words[i:i + shingle_size]).encode('utf-8', 'surrogatepass'), digest_size=8).digest()
+            value = int.from_bytes(digest, 'little')
+            index, value = value % bins, value // bins
+            if signature[index] is None or value < signature[index]:
+                signature[index] = value
+        # Empty bins borrow from the next filled one so short texts still compare bin by bin
+        following = next(value for value in signature if value is not None)
+        for index in reversed(range(bins)):
+            if signature[index] is None:
+                signature[index] = following
+            else:
+                following = signature[index]
+        return signature
+
+    @staticmethod
+    @profiled('extract.document')
+    def extract_document(file_path, segmenter='spacy', extractor=None, minhash=False):
+        # Runs in the extraction pool, so it must stay picklable and API-free
+        extracted = (extractor or DocumentExtractor()).extract(file_path)
+        if isinstance(extracted['content'], TextStream):
+            # Cleaned and split as the chunks are read; near-duplicates are compared on the first block
+            signature = None
+            if minhash:
+                blocks = extracted['content'].iter_text()
+                signature = FileUtils.minhash(FileUtils.clean_content(next(blocks, '')))
+                blocks.close()
+            return {'content': extracted['content'], 'metadata': extracted['metadata'], 'sentences': None, 'minhash': signature}
+        content = FileUtils.clean_content(extracted['content'])
+        return {
+            'content': content,
+            'metadata': extracted['metadata'],
+            'sentences': FileUtils.split_sentences(content, segmenter) if content else [],
+            'minhash': FileUtils.minhash(content) if minhash else None
+        }
+
+class HtmlTextParser(HTMLParser):
+    skip_tags = {'script', 'style', 'noscript', 'template', 'svg'}
+    block_tags = {'p', 'div', 'br', 'li', 'tr', 'td', 'th', 'table', 'section', 'article', 'header', 'footer',
+                  'h1', 'h2', 'h3', 'h4', 'h5', 'h6', 'pre', 'blockquote', 'hr'}
+    meta_names = {'author', 'description', 'keywords', 'og:title'}
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.parts = []
+        self.title = []
+        self.metadata = {}
+        self.skip = 0
+        self.in_title = False
+
+    def handle_starttag(self, tag, attrs):
+        if tag in self.skip_tags:
+            self.skip += 1
+        elif tag == 'title':
+            self.in_title = True
+        elif tag == 'meta':
+            attrs = dict(attrs)
+            name = (attrs.get('name') or attrs.get('property') or '').lower()
+            if name in self.meta_names and attrs.get('content'):
+                self.metadata[name] = attrs['content']
+        if tag in self.block_tags:
+            self.parts.append('\n')
+
+    def handle_endtag(self, tag):
+        if tag in self.skip_tags and self.skip:
+            self.skip -= 1
+        elif tag == 'title':
+            self.in_title = False
+        if tag in self.block_tags:
+            self.parts.append('\n')
+
+    def handle_data(self, data):
+        if self.skip:
+            return
+        if self.in_title:
+            self.title.append(data)
+        else:
+            self.parts.append(data)
+
+class DocumentExtractor:
+    # Known container formats go straight to tika; everything else is sniffed as text or HTML
+    tika_signatures = (
+        b'%PDF-',
+        b'PK\x03\x04',
+        b'\xd0\xcf\x11\xe0\xa1\xb1\x1a\xe1',
+        b'{\\rtf',
+    )
+    html_markers = (b'<!doctype html', b'<html', b'<head', b'<body')
+    sniff_bytes = 8192
+
+    def __init__(self, tika_endpoints=None, max_bytes=32 * 1024 * 1024, stream_bytes=4 * 1024 * 1024):
+        self.tika_endpoints = tika_endpoints or ['http://localhost:9998']
+        self.max_bytes = max_bytes
+        self.stream_bytes = stream_bytes
+        self.reset_endpoints()
+
+    def reset_endpoints(self):
+        self.lock = threading.Lock()
+        self.in_flight = dict.fromkeys(self.tika_endpoints, 0)
+        # A random start spreads the extraction processes over the servers
+        self.turn = random.randrange(len(self.tika_endpoints))
+
+    def __getstate__(self):
+        # Sent to the extraction processes; each one tracks its own load
+        return {'tika_endpoints': self.tika_endpoints, 'max_bytes': self.max_bytes, 'stream_bytes': self.stream_bytes}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.reset_endpoints()
+
+    @staticmethod
+    def local_endpoints(count, first_port=9998):
+        return [f"http://localhost:{first_port + i}" for i in range(max(1, count))]
+
+    def warm_up(self):
+        # tika-python starts a local server on first use; do it for every server at once, before the crawl
+        from tika import parser
+
+        def ping(endpoint):
+            try:
+                parser.from_buffer('warm up', serverEndpoint=endpoint)
+            except Exception as e:
+                print(f"Tika server at {endpoint} is not available: {e}")
+
+        with ThreadPoolExecutor(max_workers=len(self.tika_endpoints)) as pool:
+            list(pool.map(ping, self.tika_endpoints))
+
+    def sniff(self, head):
+        if head.startswith(self.tika_signatures):
+            return 'tika'
+        if head.startswith((b'\xff\xfe', b'\xfe\xff')):
+            return 'text'
+        start = head.lstrip(b'\xef\xbb\xbf \t\r\n').lower()
+        if start.startswith(self.html_markers) or (start.startswith(b'<?xml') and b'<html' in start):
+            return 'html'
+        if b'\x00' in head:
+            return 'tika'
+        return 'text'
+
+    @profiled('extract')
+    def extract(self, file_path):
+        size = FileUtils.file_size(file_path)
+        with FileUtils.open_file(file_path) as file:
+            head = file.read(self.sniff_bytes)
+            kind = self.sniff(head)
+            if kind == 'text' and size > self.stream_bytes and self.decode_text(head, final=False) is not None:
+                # Large text is never read whole; the chunks that are needed are read from the file
+                return {'content': TextStream(file_path, head), 'metadata': {'Content-Type': 'text/plain'}}
+            if kind != 'tika':
+                data = (head + file.read(max(0, self.max_bytes - len(head))))[:self.max_bytes]
+        if size > self.max_bytes:
+            if kind == 'tika':
+                print(f"Skipping {file_path}: {size} bytes is over the extraction limit of {self.max_bytes}")
+                return {'content': '', 'metadata': {}}
+            print(f"Reading the first {self.max_bytes} of {size} bytes of {file_path}")
+
+        if kind == 'text':
+            content = self.decode_text(data, final=size <= self.max_bytes)
+            if content is not None:
+                return {'content': content, 'metadata': {'Content-Type': 'text/plain'}}
+            # Not UTF-8; tika detects the charset
+            if size > self.max_bytes:
+                return {'content': '', 'metadata': {}}
+            return self.parse_with_tika(file_path)
+        if kind == 'html':
+            return self.parse_html(data)
+        return self.parse_with_tika(file_path)
+
+    @staticmethod
+    def decode_text(data, final=True):
+        encoding = 'utf-16' if data.startswith((b'\xff\xfe', b'\xfe\xff')) else 'utf-8-sig'
+        try:
+            # A cut at max_bytes may split a character, which only a non-final decode tolerates
+            return codecs.getincrementaldecoder(encoding)().decode(data, final=final)
+        except UnicodeDecodeError:
+            return None
+
+    @staticmethod
+    @profiled('extract.html')
+    def parse_html(data):
+        match = re.search(rb'<meta[^>]+charset=["\']?([\w-]+)', data[:4096], re.IGNORECASE)
+        encoding = 'utf-8'
+        if match:
+            try:
+                encoding = codecs.lookup(match.group(1).decode('ascii')).name
+            except LookupError:
+                pass
+        parser = HtmlTextParser()
+        parser.feed(data.decode(encoding, errors='replace'))
+        parser.close()
+        title = "".join(parser.title).strip()
+        metadata = dict(parser.metadata, **{'Content-Type': 'text/html'})
+        if title:
+            metadata['dc:title'] = title
+        content = "".join(parser.parts)
+        return {'content': f"{title}\n{content}" if title else content, 'metadata': metadata}
+
+    def acquire_endpoint(self):
+        with self.lock:
+            self.turn += 1
+            offset = self.turn % len(self.tika_endpoints)
+            endpoints = self.tika_endpoints[offset:] + self.tika_endpoints[:offset]
+            endpoint = min(endpoints, key=self.in_flight.get)
+            self.in_flight[endpoint] += 1
+            return endpoint
+
+    def release_endpoint(self, endpoint):
+        with self.lock:
+            self.in_flight[endpoint] -= 1
+
+    @profiled('extract.tika')
+    def parse_with_tika(self, file_path):
+        from tika import parser
+        endpoint = self.acquire_endpoint()
+        try:
+            # One request returns both the text and the metadata
+            if ArchiveReader.split(file_path)[0] is not None:
+                with FileUtils.open_file(file_path) as file:
+                    parsed = parser.from_buffer(file.read(), serverEndpoint=endpoint)
+            else:
+                parsed = parser.from_file(file_path, serverEndpoint=endpoint)
+        finally:
+            self.release_endpoint(endpoint)
+        content = parsed.get('content') or ''
+        return {'content': content[:self.max_bytes], 'metadata': parsed.get('metadata') or {}}
+
+class TextStream:
+    # A large text file read a block at a time, cleaned and split per block
+    def __init__(self, path, head=b'', block_size=1024 * 1024):
+        self.path = path
+        self.block_size = block_size
+        self.size = FileUtils.file_size(path)
+        if head.startswith((b'\xff\xfe', b'\xfe\xff')):
+            self.encoding = 'utf-16-le' if head.startswith(b'\xff\xfe') else 'utf-16-be'
+            self.start = 2
+        else:
+            self.encoding = 'utf-8'
+            self.start = 3 if head.startswith(b'\xef\xbb\xbf') else 0
+
+    def iter_text(self, start=None, block_size=None):
+        start = self.start if start is None else max(start, self.start)
+        if self.encoding != 'utf-8':
+            start -= (start - self.start) % 2
+        decoder = codecs.getincrementaldecoder(self.encoding)(errors='replace')
+        with FileUtils.open_file(self.path) as file:
+            file.seek(start)
+            first = True
+            while True:
+                data = file.read(block_size or self.block_size)
+                if not data:
+                    break
+                if first and start > self.start and self.encoding == 'utf-8':
+                    # Landed inside a character; skip to the next one
+                    data = data.lstrip(bytes(range(0x80, 0xc0)))
+                first = False
+                yield decoder.decode(data)
+        yield decoder.decode(b'', final=True)
+
+    def iter_sentences(self, segmenter='spacy', start=None, block_size=None):
+        # The last sentence of a block may continue in the next one, so it is carried over instead of yielded
+        skip_first = start is not None and start > self.start
+        carry = ""
+        for block in self.iter_text(start, block_size):
+            text = carry + FileUtils.clean_content(block, strip=False)
+            sentences = list(FileUtils.iter_sentences(text, segmenter))
+            carry = text[text.rindex(sentences[-1]):] if sentences else text
+            if len(carry) > self.block_size:
+                # No sentence end in a whole block; split_oversized cuts it up later
+                carry = ""
+            for sentence in sentences[:-1] if carry else sentences:
+                if skip_first:
+                    # Starting at an arbitrary byte, the first sentence is only a fragment
+                    skip_first = False
+                    continue
+                yield sentence.strip()
+        if carry.strip() and not skip_first:
+            yield carry.strip()
+
+class ArchiveReader:
+    # zip, tar and gz come from the standard library; rar and 7z need rarfile and py7zr
+    separator = '!'
+    tar_extensions = ('.tar', '.tgz', '.tar.gz', '.tar.bz2', '.tbz2', '.tar.xz', '.txz')
+    warned = set()
+    hashes = {}
+    sizes = {}
+
+    @classmethod
+    def reset(cls):
+        # Open tar handles must not be shared with a forked extraction process
+        cls.lock = threading.Lock()
+        cls.tar_handles = OrderedDict()
+
+    @classmethod
+    def kind(cls, path):
+        name = path.lower()
+        if name.endswith('.zip'):
+            return 'zip'
+        if name.endswith(cls.tar_extensions):
+            return 'tar'
+        if name.endswith('.gz'):
+            return 'gz'
+        if name.endswith('.rar'):
+            return 'rar'
+        if name.endswith('.7z'):
+            return '7z'
+        return None
+
+    @classmethod
+    def split(cls, path):
+        # The archive is the first prefix before a separator that is an archive on disk, so '!' in folder names is fine
+        index = path.find(cls.separator)
+        while index != -1:
+            archive = path[:index]
+            if cls.kind(archive) and os.path.isfile(archive):
+                return archive, path[index + 1:].replace(os.sep, '/')
+            index = path.find(cls.separator, index + 1)
+        return None, None
+
+    @classmethod
+    def module(cls, name):
+        try:
+            return __import__(name)
+        except ImportError:
+            if name not in cls.warned:
+                print(f"{name} is not installed, skipping archives that need it")
+                cls.warned.add(name)
+            return None
+
+    @classmethod
+    def archive_hash(cls, path):
+        stat_result = os.stat(path)
+        key = (path, stat_result.st_size, stat_result.st_mtime)
+        if key not in cls.hashes:
+            cls.hashes[key] = FileUtils.hash_file(path)
+        return cls.hashes[key]
+
+    @classmethod
+    def members(cls, path):
+        kind = cls.kind(path)
+        if kind == 'zip':
+            with zipfile.ZipFile(path) as archive:
+                for info in archive.infolist():
+                    if not info.is_dir():
+                        yield info.filename, info.file_size, datetime(*info.date_time).timestamp()
+        elif kind == 'tar':
+            with tarfile.open(path) as archive:
+                for info in archive:
+                    if info.isfile():
+                        yield info.name, info.size, info.mtime
+        elif kind == 'gz':
+            yield os.path.basename(path)[:-3], cls.member_size(path, None), os.path.getmtime(path)
+        elif kind == 'rar':
+            rarfile = cls.module('rarfile')
+            if rarfile is not None:
+                with rarfile.RarFile(path) as archive:
+                    for info in archive.infolist():
+                        if not info.is_dir():
+                            yield info.filename, info.file_size, datetime(*info.date_time).timestamp()
+        elif kind == '7z':
+            py7zr = cls.module('py7zr')
+            if py7zr is not None:
+                with py7zr.SevenZipFile(path) as archive:
+                    for info in archive.list():
+                        if not info.is_directory:
+                            modified = info.creationtime.timestamp() if info.creationtime else os.path.getmtime(path)
+                            yield info.filename, info.uncompressed, modified
+
+    @classmethod
+    def member_size(cls, path, member):
+        # The crawl already listed the archive, so its sizes are used when this process saw them
+        size = cls.sizes.get(f"{path}{cls.separator}{member}")
+        if size is not None:
+            return size
+        kind = cls.kind(path)
+        if kind == 'zip':
+            with zipfile.ZipFile(path) as archive:
+                return archive.getinfo(member).file_size
+        if kind == 'tar':
+            handle = cls.tar_handle(path)
+            with handle.lock:
+                return cls.tar_member(handle, member).size
+        if kind == 'gz':
+            # The gzip trailer holds the uncompressed size modulo 4 GiB
+            with open(path, 'rb') as file:
+                file.seek(-4, os.SEEK_END)
+                return int.from_bytes(file.read(4), 'little')
+        if kind == 'rar':
+            with cls.module('rarfile').RarFile(path) as archive:
+                return archive.getinfo(member).file_size
+        with cls.module('py7zr').SevenZipFile(path) as archive:
+            return next(info.uncompressed for info in archive.list() if info.filename == member)
+
+    @classmethod
+    def tar_handle(cls, path):
+        # Compressed tars cannot seek back cheaply, so a handle is kept open and read forward in crawl order
+        with cls.lock:
+            handle = cls.tar_handles.pop(path, None)
+            if handle is None:
+                handle = SimpleNamespace(tar=tarfile.open(path), lock=threading.RLock(), infos={})
+            cls.tar_handles[path] = handle
+            for old_path in list(cls.tar_handles)[:-4]:
+                # A handle still being read is closed later instead
+                old = cls.tar_handles[old_path]
+                if old.lock.acquire(blocking=False):
+                    del cls.tar_handles[old_path]
+                    old.tar.close()
+                    old.lock.release()
+        return handle
+
+    @staticmethod
+    def tar_member(handle, member):
+        # getmember would read the index of the whole archive first
+        info = handle.infos.get(member)
+        while info is None:
+            info = handle.tar.next()
+            if info is None:
+                raise KeyError(f"{member} not found in archive")
+            handle.infos[info.name] = info
+            info = info if info.name == member else None
+        return info
+
+    @classmethod
+    @contextmanager
+    def open(cls, path, member):
+        kind = cls.kind(path)
+        if kind == 'zip':
+            with zipfile.ZipFile(path) as archive, archive.open(member) as file:
+                yield file
+        elif kind == 'tar':
+            # The member is read in place, so a large text file inside a tar is streamed like any other
+            handle = cls.tar_handle(path)
+            with handle.lock:
+                yield handle.tar.extractfile(cls.tar_member(handle, member))
+        elif kind == 'gz':
+            with gzip.open(path, 'rb') as file:
+                yield file
+        elif kind == 'rar':
+            with cls.module('rarfile').RarFile(path) as archive, archive.open(member) as file:
+                yield file
+        else:
+            with cls.module('py7zr').SevenZipFile(path) as archive:
+                yield archive.read([member])[member]
+
+ArchiveReader.reset()
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=ArchiveReader.reset)
 
 class FileCrawler:
     def __init__(self):
         self.file_categories = {
-            "document": ["txt", "pdf", "doc", "docx", "md", "rtf"],
+            "document": ["txt", "pdf", "doc", "docx", "md", "rtf", "html", "htm"],
             "spreadsheet": ["xls", "xlsx", "csv", "ods"],
             "presentation": ["ppt", "pptx", "odp"],
             "image": ["jpg", "jpeg", "png", "gif", "bmp", "tiff"],
@@ -142,86 +892,671 @@ class FileCrawler:
             "video": ["mp4", "avi", "mov", "wmv", "flv", "mkv"],
             "web": ["html", "htm", "xml", "css", "js"],
             "code": ["py", "java", "cpp", "c", "js", "php", "rb"],
-            "archive": ["zip", "rar", "7z", "tar", "gz"]
+            "archive": ["zip", "rar", "7z", "tar", "gz", "tgz"]
         }
 
-    def crawl(self, directory, recursive=False, categories=None):
-        file_list = {}
-        walker = os.walk(directory) if recursive else [next(os.walk(directory))]
-
-        for root, _, files in walker:
-            sorted_files = os_sorted(files)
-            for file in sorted_files:
-                file_path = os.path.join(root, file)
-                file_extension = os.path.splitext(file)[1].lower().lstrip('.')
-                if self.should_include_file(file_extension, categories):
-                    category = self.get_file_category(file_extension)
-                    if category not in file_list:
-                        file_list[category] = []
-                    file_list[category].append(self.get_file_info(file_path, file_extension))
+        self.extension_categories = {}
+        for category, extensions in self.file_categories.items():
+            for extension in extensions:
+                self.extension_categories.setdefault(extension, category)
+        self.category_extensions = {category: set(extensions) for category, extensions in self.file_categories.items()}
 
+    def crawl(self, directory, recursive=False, categories=None, workers=0, archives=False):
+        file_list = {}
+        for file_info in self.iter_files(directory, recursive=recursive, categories=categories, workers=workers, archives=archives):
+            file_list.setdefault(file_info['category'], []).append(file_info)
         return file_list
 
+    def iter_files(self, directory, recursive=False, categories=None, workers=0, archives=False):
+        # Directories are scanned ahead on the pool but yielded in a fixed depth-first order
+        executor = ThreadPoolExecutor(max_workers=workers) if workers > 0 else None
+        try:
+            pending = [self.submit_scan(executor, directory)]
+            while pending:
+                files, subdirectories = pending.pop().result()
+                for file_path, file_extension, stat_result in files:
+                    if archives and ArchiveReader.kind(file_path):
+                        yield from self.iter_archive(file_path, categories)
+                    elif self.should_include_file(file_extension, categories):
+                        yield self.get_file_info(file_path, file_extension, stat_result)
+                if recursive:
+                    pending.extend(self.submit_scan(executor, subdirectory) for subdirectory in reversed(subdirectories))
+        finally:
+            if executor is not None:
+                executor.shutdown(cancel_futures=True)
+
+    def submit_scan(self, executor, directory):
+        if executor is not None:
+            return executor.submit(self.scan_directory, directory)
+        future = Future()
+        future.set_result(self.scan_directory(directory))
+        return future
+
+    def scan_directory(self, directory):
+        files = []
+        subdirectories = []
+        try:
+            with os.scandir(directory) as entries:
+                entries = list(entries)
+        except OSError as e:
+            print(f"Cannot read directory {directory}: {e}")
+            return files, subdirectories
+        for entry in os_sorted(entries, key=lambda entry: entry.name):
+            try:
+                if entry.is_dir(follow_symlinks=False):
+                    subdirectories.append(entry.path)
+                elif entry.is_file():
+                    file_extension = os.path.splitext(entry.name)[1].lower().lstrip('.')
+                    files.append((entry.path, file_extension, entry.stat()))
+            except OSError as e:
+                print(f"Cannot read {entry.path}: {e}")
+        return files, subdirectories
+
     def get_files_with_json(self, directory):
         file_json_pairs = []
-        for root, _, files in os.walk(directory):
-            for file in files:
-                if not file.endswith('_info.json'):
-                    file_path = os.path.join(root, file)
-                    json_path = f"{file_path}_info.json"
-                    if os.path.exists(json_path):
-                        file_json_pairs.append((file_path, json_path))
+        pending = [directory]
+        while pending:
+            files, subdirectories = self.scan_directory(pending.pop())
+            names = {os.path.basename(file_path) for file_path, _, _ in files}
+            for file_path, _, _ in files:
+                file_name = os.path.basename(file_path)
+                if not file_name.endswith('_info.json') and f"{file_name}_info.json" in names:
+                    file_json_pairs.append((file_path, f"{file_path}_info.json"))
+            pending.extend(reversed(subdirectories))
         return file_json_pairs
 
     def should_include_file(self, file_extension, categories):
         if not categories or 'all' in categories:
             return True
-        return any(file_extension in self.file_categories.get(category, []) for category in categories)
+        return any(file_extension in self.category_extensions.get(category, ()) for category in categories)
+
+    def iter_archive(self, archive_path, categories=None):
+        # Members become virtual files named "archive!member"; archives inside archives are not opened
+        try:
+            for member, size, modified in ArchiveReader.members(archive_path):
+                file_extension = os.path.splitext(member)[1].lower().lstrip('.')
+                if ArchiveReader.kind(member) or not self.should_include_file(file_extension, categories):
+                    continue
+                file_path = f"{archive_path}{ArchiveReader.separator}{member}"
+                ArchiveReader.sizes[file_path] = size
+                stat_result = SimpleNamespace(st_size=size, st_ctime=modified, st_mtime=modified)
+                yield dict(self.get_file_info(file_path, file_extension, stat_result), archive=archive_path)
+        except Exception as e:
+            print(f"Cannot read archive {archive_path}: {e}")
 
     def get_file_category(self, file_extension):
-        for category, extensions in self.file_categories.items():
-            if file_extension in extensions:
-                return category
-        return "other"
+        return self.extension_categories.get(file_extension, "other")
 
-    def get_file_info(self, file_path, file_extension):
+    def get_file_info(self, file_path, file_extension, stat_result=None):
         return {
             'path': file_path,
             'directory': os.path.dirname(file_path),
             'name': os.path.basename(file_path),
             'extension': file_extension,
             'category': self.get_file_category(file_extension),
-            'file_metadata': FileUtils.get_basic_metadata(file_path)
+            'file_metadata': FileUtils.get_basic_metadata(file_path, stat_result)
         }
 
+class ResultCache:
+    def __init__(self, cache_dir, max_bytes=512 * 1024 * 1024):
+        FileUtils.ensure_dir(cache_dir)
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(os.path.join(cache_dir, 'results.db'), check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS results (key TEXT PRIMARY KEY, value TEXT NOT NULL, size INTEGER NOT NULL, accessed REAL NOT NULL)")
+        self.db.execute("CREATE INDEX IF NOT EXISTS results_accessed ON results (accessed)")
+        self.db.commit()
+        self.total_bytes = self.db.execute("SELECT COALESCE(SUM(size), 0) FROM results").fetchone()[0]
+
+    @staticmethod
+    def make_key(*parts):
+        return hashlib.sha256(json.dumps(parts, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+    def get(self, key):
+        with self.lock:
+            row = self.db.execute("SELECT value FROM results WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            self.db.execute("UPDATE results SET accessed = ? WHERE key = ?", (time.time(), key))
+            self.db.commit()
+        return json.loads(row[0])
+
+    def contains(self, key):
+        with self.lock:
+            return self.db.execute("SELECT 1 FROM results WHERE key = ?", (key,)).fetchone() is not None
+
+    def put(self, key, value):
+        data = json.dumps(value, ensure_ascii=False)
+        size = len(data.encode('utf-8'))
+        with self.lock:
+            row = self.db.execute("SELECT size FROM results WHERE key = ?", (key,)).fetchone()
+            if row is not None:
+                self.total_bytes -= row[0]
+            self.db.execute("INSERT OR REPLACE INTO results (key, value, size, accessed) VALUES (?, ?, ?, ?)", (key, data, size, time.time()))
+            self.total_bytes += size
+            if self.total_bytes > self.max_bytes:
+                self.evict(int(self.max_bytes * 0.9))
+            self.db.commit()
+
+    def evict(self, target_bytes):
+        # Least recently used entries go first
+        rows = self.db.execute("SELECT key, size FROM results ORDER BY accessed").fetchall()
+        for key, size in rows:
+            if self.total_bytes <= target_bytes:
+                break
+            self.db.execute("DELETE FROM results WHERE key = ?", (key,))
+            self.total_bytes -= size
+
+class MetadataStore:
+    @staticmethod
+    def open(kind, path):
+        if kind == 'sqlite':
+            return SQLiteMetadataStore(path)
+        if kind == 'jsonl':
+            return JsonlMetadataStore(path)
+        raise ValueError(f"Unknown metadata store: {kind}")
+
+    @staticmethod
+    def entry_path(name, metadata):
+        return metadata.get('FullPath') or name
+
+    @staticmethod
+    def entry_name(path, metadata):
+        return metadata.get('File') or os.path.basename(path)
+
+    def sync_from_json(self, json_path):
+        # The JSON export is the source of truth when something else (e.g. the renamer) changed it
+        if not os.path.exists(json_path):
+            return
+        if len(self) and os.path.getmtime(json_path) <= os.path.getmtime(self.path):
+            return
+        data = FileUtils.read_from_json(json_path)
+        if data is None:
+            return
+        self.clear()
+        for name, metadata in data.items():
+            self.put(metadata, path=self.entry_path(name, metadata))
+        print(f"Imported {len(data)} entries from {json_path}")
+
+    def export_json(self, json_path):
+        data = {}
+        for path, metadata in self.items():
+            name = self.entry_name(path, metadata)
+            # Same-named files from different directories keep their full path as key
+            data[path if name in data else name] = metadata
+        temp_path = f"{json_path}.tmp"
+        with open(temp_path, 'w') as f:
+            json.dump(data, f, indent=2)
+        os.replace(temp_path, json_path)
+        os.utime(self.path)
+
+class JsonlMetadataStore(MetadataStore):
+    def __init__(self, path, compact_ratio=2, min_compact=1000):
+        self.path = path
+        self.compact_ratio = compact_ratio
+        self.min_compact = min_compact
+        self.entries = {}
+        self.log_lines = 0
+        # The crawler thread records moves while the main thread records results
+        self.lock = threading.RLock()
+        if os.path.exists(path):
+            with open(path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    line = line.strip()
+                    if not line:
+                        continue
+                    try:
+                        record = json.loads(line)
+                    except json.JSONDecodeError:
+                        # A crash can leave a partial last line
+                        continue
+                    self.log_lines += 1
+                    if record.get('deleted'):
+                        self.entries.pop(record['path'], None)
+                    else:
+                        self.entries[record['path']] = record['metadata']
+        self.log = open(path, 'a', encoding='utf-8')
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, path):
+        return self.entries.get(path)
+
+    def items(self):
+        with self.lock:
+            return list(self.entries.items())
+
+    def append(self, record):
+        self.log.write(json.dumps(record, ensure_ascii=False) + "\n")
+        self.log.flush()
+        self.log_lines += 1
+        if self.log_lines > max(self.min_compact, len(self.entries) * self.compact_ratio):
+            self.compact()
+
+    def put(self, metadata, path=None):
+        path = path or metadata['FullPath']
+        with self.lock:
+            self.entries[path] = metadata
+            self.append({'path': path, 'metadata': metadata})
+
+    def remove(self, path):
+        with self.lock:
+            if self.entries.pop(path, None) is not None:
+                self.append({'path': path, 'deleted': True})
+
+    def clear(self):
+        with self.lock:
+            self.entries = {}
+            self.compact()
+
+    def compact(self):
+        with self.lock:
+            self.rewrite()
+
+    def rewrite(self):
+        self.log.close()
+        temp_path = f"{self.path}.tmp"
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            for path, metadata in self.entries.items():
+                f.write(json.dumps({'path': path, 'metadata': metadata}, ensure_ascii=False) + "\n")
+        os.replace(temp_path, self.path)
+        self.log_lines = len(self.entries)
+        self.log = open(self.path, 'a', encoding='utf-8')
+
+    def close(self):
+        with self.lock:
+            if self.log_lines > len(self.entries):
+                self.rewrite()
+            self.log.close()
+
+class SQLiteMetadataStore(MetadataStore):
+    def __init__(self, path):
+        self.path = path
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS metadata (path TEXT PRIMARY KEY, name TEXT NOT NULL, data TEXT NOT NULL, seq INTEGER NOT NULL)")
+        self.db.execute("CREATE INDEX IF NOT EXISTS metadata_name ON metadata (name)")
+        self.db.commit()
+        self.lock = threading.RLock()
+        self.seq = self.db.execute("SELECT COALESCE(MAX(seq), 0) FROM metadata").fetchone()[0]
+
+    def __len__(self):
+        with self.lock:
+            return self.db.execute("SELECT COUNT(*) FROM metadata").fetchone()[0]
+
+    def get(self, path):
+        with self.lock:
+            row = self.db.execute("SELECT data FROM metadata WHERE path = ?", (path,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def items(self):
+        with self.lock:
+            rows = self.db.execute("SELECT path, data FROM metadata ORDER BY seq").fetchall()
+        return [(path, json.loads(data)) for path, data in rows]
+
+    def put(self, metadata, path=None):
+        path = path or metadata['FullPath']
+        name = self.entry_name(path, metadata)
+        with self.lock:
+            self.seq += 1
+            self.db.execute("INSERT OR REPLACE INTO metadata (path, name, data, seq) VALUES (?, ?, ?, ?)", (path, name, json.dumps(metadata, ensure_ascii=False), self.seq))
+            self.db.commit()
+
+    def remove(self, path):
+        with self.lock:
+            self.db.execute("DELETE FROM metadata WHERE path = ?", (path,))
+            self.db.commit()
+
+    def clear(self):
+        with self.lock:
+            self.db.execute("DELETE FROM metadata")
+            self.db.commit()
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+class FileManifest:
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS files (path TEXT PRIMARY KEY, size INTEGER NOT NULL, modified TEXT NOT NULL, hash TEXT)")
+        self.db.execute("CREATE INDEX IF NOT EXISTS files_hash ON files (hash)")
+        self.db.commit()
+
+    def get(self, path):
+        with self.lock:
+            return self.db.execute("SELECT size, modified, hash FROM files WHERE path = ?", (path,)).fetchone()
+
+    def put(self, path, size, modified, content_hash=None):
+        with self.lock:
+            self.db.execute("INSERT OR REPLACE INTO files (path, size, modified, hash) VALUES (?, ?, ?, ?)", (path, size, modified, content_hash))
+            self.db.commit()
+
+    def remove(self, path):
+        with self.lock:
+            self.db.execute("DELETE FROM files WHERE path = ?", (path,))
+            self.db.commit()
+
+    def find_by_hash(self, content_hash):
+        with self.lock:
+            return [row[0] for row in self.db.execute("SELECT path FROM files WHERE hash = ?", (content_hash,))]
+
+    def is_unchanged(self, path, file_metadata):
+        entry = self.get(path)
+        return entry is not None and entry[0] == file_metadata['size'] and entry[1] == file_metadata['modified']
+
+    def get_hash(self, path, file_metadata):
+        # Hashes are only computed when needed and reused while size and mtime match
+        entry = self.get(path)
+        if entry is not None and entry[2] and entry[0] == file_metadata['size'] and entry[1] == file_metadata['modified']:
+            return entry[2]
+        return FileUtils.hash_file(path)
+
+    def record(self, path, file_metadata, content_hash=None):
+        if content_hash is None:
+            content_hash = self.get_hash(path, file_metadata)
+        self.put(path, file_metadata['size'], file_metadata['modified'], content_hash)
+
+    def close(self):
+        self.db.close()
+
+class PerceptualIndex:
+    # Hashes within max_distance bits must agree exactly on at least one of max_distance + 1 bands
+    def __init__(self, max_distance=6, bits=64):
+        self.max_distance = max_distance
+        self.bands = [(i * bits // (max_distance + 1), (i + 1) * bits // (max_distance + 1)) for i in range(max_distance + 1)]
+        self.buckets = [{} for _ in self.bands]
+        self.captions = {}
+        self.lock = threading.Lock()
+
+    def band_keys(self, value):
+        for index, (start, end) in enumerate(self.bands):
+            yield index, (value >> start) & ((1 << (end - start)) - 1)
+
+    def find(self, phash):
+        value = int(phash, 16)
+        best = None
+        with self.lock:
+            for index, key in self.band_keys(value):
+                for other in self.buckets[index].get(key, ()):
+                    distance = bin(value ^ other).count('1')
+                    if distance <= self.max_distance and (best is None or distance < best[0]):
+                        best = (distance, other)
+            return self.captions[best[1]] if best is not None else None
+
+    def add(self, phash, caption):
+        value = int(phash, 16)
+        with self.lock:
+            if value not in self.captions:
+                for index, key in self.band_keys(value):
+                    self.buckets[index].setdefault(key, []).append(value)
+            self.captions[value] = caption
+
+class MinHashIndex:
+    # LSH over MinHash signatures: documents that agree on every bin of at least one band are compared in full
+    def __init__(self, threshold=0.9, bands=16):
+        self.threshold = threshold
+        self.bands = bands
+        self.buckets = [{} for _ in range(bands)]
+        self.entries = []
+        self.lock = threading.Lock()
+
+    def band_keys(self, signature):
+        rows = len(signature) // self.bands
+        for index in range(self.bands):
+            yield index, tuple(signature[index * rows:(index + 1) * rows])
+
+    @staticmethod
+    def similarity(signature, other):
+        return sum(a == b for a, b in zip(signature, other)) / len(signature)
+
+    def find(self, signature):
+        best = None
+        with self.lock:
+            for index, key in self.band_keys(signature):
+                for entry in self.buckets[index].get(key, ()):
+                    similarity = self.similarity(signature, self.entries[entry][0])
+                    if similarity >= self.threshold and (best is None or similarity > best[0]):
+                        best = (similarity, entry)
+            return (self.entries[best[1]][1], best[0]) if best is not None else None
+
+    def add(self, signature, value):
+        with self.lock:
+            for index, key in self.band_keys(signature):
+                self.buckets[index].setdefault(key, []).append(len(self.entries))
+            self.entries.append((signature, value))
+
+class FileScheduler:
+    # Reorders the crawl within a look-ahead window. fifo keeps crawl order, sjf runs the cheapest files first,
+    # fair shares estimated LLM time between categories by weight, and deadline runs the most valuable files per
+    # second that can still finish within the time budget
+    policies = ('fifo', 'sjf', 'fair', 'deadline')
+
+    def __init__(self, policy='fifo', estimate=None, weights=None, window=1000, time_budget=None):
+        self.policy = policy
+        self.estimate = estimate or (lambda item: 0.0)
+        self.weights = weights or {}
+        self.window = window if policy != 'fifo' else 1
+        self.time_budget = time_budget
+        self.start = time.time()
+        self.correction = 1.0
+        self.served = {}
+        self.skipped = 0
+        self.lock = threading.Lock()
+
+    def weight(self, category):
+        return self.weights.get(category, 1.0)
+
+    def remaining(self):
+        if self.time_budget is None:
+            return None
+        return self.time_budget - (time.time() - self.start)
+
+    def complete(self, cost, seconds):
+        # Estimates are scaled by how long files really take, learned as they finish
+        if cost > 0 and seconds > 0:
+            with self.lock:
+                self.correction = 0.8 * self.correction + 0.2 * seconds / cost
+
+    def priority(self, cost, category, order):
+        if self.policy == 'sjf':
+            return cost
+        if self.policy == 'deadline':
+            return -self.weight(category) / max(cost, 0.001)
+        return order
+
+    def schedule(self, items):
+        # Items are (category, ...) tuples; yields (estimated cost, item)
+        items = iter(items)
+        queues = {}
+        order = 0
+        pending = 0
+        exhausted = False
+        # The window starts small and grows by one per file handed out, so the first file does not wait for a
+        # full window to be read (and hashed) and the look-ahead is built two files per file processed
+        limit = min(self.window, 4)
+        while True:
+            while not exhausted and pending < limit:
+                item = next(items, None)
+                if item is None:
+                    exhausted = True
+                    break
+                cost = self.estimate(item) if self.policy != 'fifo' else 0.0
+                key = item[0] if self.policy == 'fair' else None
+                if key not in queues:
+                    # A category seen late starts level with the others instead of catching up on their share
+                    queues[key] = []
+                    self.served[key] = min(self.served.values(), default=0.0)
+                heapq.heappush(queues[key], (self.priority(cost, item[0], order), order, cost, item))
+                order += 1
+                pending += 1
+            if pending == 0:
+                break
+            remaining = self.remaining()
+            if remaining is not None and remaining <= 0:
+                print(f"\nTime budget used up; stopping with {pending} queued files and the rest of the crawl left for the next run")
+                break
+            key = min((key for key in queues if queues[key]), key=lambda key: self.served[key])
+            _, _, cost, item = heapq.heappop(queues[key])
+            pending -= 1
+            limit = min(self.window, limit + 1)
+            if self.policy == 'deadline' and remaining is not None and cost * self.correction > remaining:
+                self.skipped += 1
+                continue
+            self.served[key] += cost / self.weight(item[0])
+            yield cost, item
+        if self.skipped:
+            print(f"\nLeft {self.skipped} files that were not expected to finish within the time budget for the next run")
+
 class TaskProcessor:
-    def __init__(self, llm_processor, task_config_path):
+    def __init__(self, llm_processor, task_config_path, cache=None, fuse=False, image_index=None):
         self.llm_processor = llm_processor
         self.task_config = FileUtils.read_from_json(task_config_path)
+        self.cache = cache
+        self.fuse = fuse
+        self.image_index = image_index
+
+    def cache_key(self, content_hash, task_config):
+        if self.cache is None or content_hash is None:
+            return None
+        return ResultCache.make_key(content_hash, task_config, self.llm_processor.model, self.llm_processor.load_template())
+
+    def is_cached(self, content_hash, tasks):
+        keys = [self.cache_key(content_hash, self.task_config.get(task)) for task in tasks]
+        return all(key is not None and self.cache.contains(key) for key in keys)
+
+    def is_caption_cached(self, content_hash):
+        cache_key = self.cache_key(content_hash, 'interrogate')
+        return cache_key is not None and self.cache.contains(cache_key)
+
+    def interrogate_image(self, image_path, content_hash=None, image=None):
+        cache_key = self.cache_key(content_hash, 'interrogate')
+        if cache_key is not None:
+            caption = self.cache.get(cache_key)
+            if caption is not None:
+                return caption
+        if image is None:
+            image = FileUtils.prepare_image(image_path, self.llm_processor.image_size)
+
+        # Burst shots and re-encoded copies reuse the caption of a near-identical image
+        phash = image.get('phash')
+        phash_key = self.cache_key(f"phash:{phash}", 'interrogate') if phash else None
+        caption = None
+        if phash and self.image_index is not None:
+            caption = self.image_index.find(phash)
+        if caption is None and phash_key is not None:
+            caption = self.cache.get(phash_key)
+
+        if caption is None:
+            caption = self.llm_processor.interrogate_image(image_path, image=image)
+            if caption and phash_key is not None:
+                self.cache.put(phash_key, caption)
+        if caption and phash and self.image_index is not None:
+            self.image_index.add(phash, caption)
+        if cache_key is not None and caption:
+            self.cache.put(cache_key, caption)
+        return caption
         
-    def process_tasks(self, file_info, content, tasks):
+    def fusable_groups(self, tasks):
+        # Whole-text tasks need their own output budget; the rest fuse by how they cover the document
+        groups = {}
+        for task in tasks:
+            task_config = self.task_config[task]
+            if task_config.get('num_chunks') == 0 or not task_config.get('fuse', True):
+                continue
+            groups.setdefault(task_config.get('mode') == 'map_reduce', []).append(task)
+        return [group for group in groups.values() if len(group) > 1]
+
+    def store_result(self, result, task, value, content_hash):
+        result[task] = FileUtils.clean_json(value)
+        task_config = self.task_config.get(task) or {}
+        cache_key = self.cache_key(content_hash, task_config)
+        # A task that asks for JSON but got back only text would replay that bad answer from the cache forever
+        expects_json = 'json_schema' in task_config or 'grammar' in task_config or task == 'metadata'
+        cacheable = (dict, list) if expects_json else (dict, list, str)
+        if cache_key is not None and isinstance(result[task], cacheable) and result[task]:
+            self.cache.put(cache_key, result[task])
+
+    @profiled('tasks')
+    def process_tasks(self, file_info, content, tasks, sentences=None, content_hash=None):
         result = {'file_info': file_info}
+        pending = []
         for task in tasks:
-            try:
-                if task not in self.task_config:
-                    print(f"Invalid task: {task}")
-                    result[task] = "Invalid task"
+            if task not in self.task_config:
+                print(f"Invalid task: {task}")
+                result[task] = "Invalid task"
+                continue
+            cache_key = self.cache_key(content_hash, self.task_config.get(task))
+            if cache_key is not None:
+                cached = self.cache.get(cache_key)
+                if cached is not None:
+                    result[task] = cached
                     continue
-                
+            pending.append(task)
+        if not pending:
+            return result
+
+        try:
+            # Content may be passed as a loader so a fully cached file is never read
+            if callable(content):
+                content = content()
+            if len(pending) > 1 and sentences is None and not isinstance(content, TextStream):
+                # Clean and segment once for all tasks instead of once per task
+                content = FileUtils.clean_content(content)
+                sentences = FileUtils.split_sentences(content, self.llm_processor.segmenter)
+        except Exception as e:
+            print(f"Error reading content: {str(e)}")
+            for task in pending:
+                result[task] = f"Error: {str(e)}"
+            return result
+
+        if self.fuse:
+            for group in self.fusable_groups(pending):
+                try:
+                    fused = self.llm_processor.process_fused(content, {task: self.task_config[task] for task in group}, sentences=sentences)
+                except Exception as e:
+                    print(f"Error processing fused tasks {', '.join(group)}: {str(e)}")
+                    continue
+                for task, value in fused.items():
+                    self.store_result(result, task, value, content_hash)
+            pending = [task for task in pending if task not in result]
+
+        for task in pending:
+            try:
                 task_config = self.task_config.get(task)
-                num_chunks = task_config.get('num_chunks')
-                
+                value = None
                 if task_config:
-                    result[task] = self.llm_processor.process_text(
+                    value = self.llm_processor.process_text(
                         content=content,  
                         task=task_config,
-                        num_chunks=num_chunks,
+                        num_chunks=task_config.get('num_chunks'),
+                        sentences=sentences,
                     )
-                result[task] = FileUtils.clean_json(result[task])    
+                self.store_result(result, task, value, content_hash)
             except Exception as e:
                 print(f"Error processing task '{task}': {str(e)}")
                 result[task] = f"Error: {str(e)}"
-        return result
+        # Fused tasks finish first; keep the order the tasks were asked for
+        return {'file_info': file_info, **{task: result[task] for task in tasks if task in result}}
+
+    def plan_tasks(self, tokens, tasks, output_fill=1.0):
+        # Same task grouping as process_tasks, counted instead of run; fused groups are keyed by their joined names
+        plans = {}
+        pending = [task for task in tasks if task in self.task_config]
+        if self.fuse:
+            for group in self.fusable_groups(pending):
+                plans["+".join(group)] = self.llm_processor.plan_fused(tokens, {task: self.task_config[task] for task in group}, output_fill)
+                pending = [task for task in pending if task not in group]
+        for task in pending:
+            plans[task] = self.llm_processor.plan_text(tokens, self.task_config[task], output_fill)
+        return plans
 
     def process_custom_task(self, content, instruction, parameters=None):
         task_config = {
@@ -236,32 +1571,493 @@ class TaskProcessor:
         }
         return self.llm_processor.process_text(content, task_config)
 
+class HttpClient:
+    # One asyncio loop on a background thread; the sync methods let existing callers stay blocking
+    default_timeouts = {
+        '/v1/generate/': 600,
+        '/extra/generate/stream': 600,
+        '/sdapi/v1/interrogate': 120,
+        '/extra/tokencount': 30,
+        '/extra/true_max_context_length': 10,
+        '/extra/generate/check': 5,
+    }
+    # Generation is not idempotent, so only connection failures are retried for it
+    no_timeout_retry = ('/v1/generate/', '/extra/generate/stream')
+
+    def __init__(self, headers=None, timeouts=None, max_retries=3, backoff=0.5, max_backoff=10, max_per_backend=8):
+        import httpx
+        self.httpx = httpx
+        self.headers = headers or {}
+        self.timeouts = dict(self.default_timeouts, **(timeouts or {}))
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.max_per_backend = max_per_backend
+        self.semaphores = {}
+        self.client = None
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        self.thread.start()
+
+    def get_client(self):
+        if self.client is None:
+            limits = self.httpx.Limits(max_connections=None, max_keepalive_connections=self.max_per_backend * 4)
+            self.client = self.httpx.AsyncClient(headers=self.headers, limits=limits)
+        return self.client
+
+    def get_semaphore(self, base_url):
+        if base_url not in self.semaphores:
+            self.semaphores[base_url] = asyncio.Semaphore(self.max_per_backend)
+        return self.semaphores[base_url]
+
+    def get_timeout(self, path):
+        for endpoint, timeout in self.timeouts.items():
+            if path.rstrip('/').endswith(endpoint.rstrip('/')):
+                return timeout
+        return 60
+
+    def retry_delay(self, attempt):
+        return random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))
+
+    def is_retryable(self, error, path):
+        if isinstance(error, (self.httpx.ConnectError, self.httpx.ConnectTimeout, self.httpx.RemoteProtocolError)):
+            return True
+        return isinstance(error, self.httpx.TimeoutException) and not path.endswith(self.no_timeout_retry)
+
+    def count_request(self, path, response):
+        if profiler.enabled:
+            profiler.count(f"requests {path}")
+            profiler.count('bytes sent', len(response.request.content))
+
+    async def arequest(self, method, base_url, path, json=None, max_retries=None):
+        max_retries = self.max_retries if max_retries is None else max_retries
+        timeout = self.get_timeout(path)
+        async with self.get_semaphore(base_url):
+            for attempt in range(max_retries + 1):
+                try:
+                    response = await self.get_client().request(method, f"{base_url}{path}", json=json, timeout=timeout)
+                    self.count_request(path, response)
+                    if response.status_code < 500 or attempt == max_retries:
+                        return response
+                except self.httpx.TransportError as e:
+                    if attempt == max_retries or not self.is_retryable(e, path):
+                        raise
+                await asyncio.sleep(self.retry_delay(attempt))
+
+    async def astream_lines(self, base_url, path, json=None, on_line=None):
+        timeout = self.get_timeout(path)
+        async with self.get_semaphore(base_url):
+            for attempt in range(self.max_retries + 1):
+                received = False
+                try:
+                    async with self.get_client().stream('POST', f"{base_url}{path}", json=json, timeout=timeout) as response:
+                        self.count_request(path, response)
+                        if response.status_code != 200:
+                            await response.aread()
+                            if response.status_code < 500 or attempt == self.max_retries:
+                                return response.status_code, None
+                        else:
+                            async for line in response.aiter_lines():
+                                received = True
+                                on_line(line)
+                            return response.status_code, True
+                except self.httpx.TransportError as e:
+                    # Retrying after part of the stream arrived would repeat tokens
+                    if received or attempt == self.max_retries or not self.is_retryable(e, path):
+                        raise
+                await asyncio.sleep(self.retry_delay(attempt))
+
+    def run(self, coroutine):
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop).result()
+
+    def request(self, method, base_url, path, json=None, max_retries=None):
+        return self.run(self.arequest(method, base_url, path, json=json, max_retries=max_retries))
+
+    def stream_lines(self, base_url, path, json=None, on_line=None):
+        return self.run(self.astream_lines(base_url, path, json=json, on_line=on_line))
+
+    def close(self):
+        if self.client is not None:
+            self.run(self.client.aclose())
+        self.loop.call_soon_threadsafe(self.loop.stop)
+
+class Backend:
+    def __init__(self, url):
+        self.url = url.rstrip('/')
+        self.in_flight = 0
+        self.failures = 0
+        self.ejected_until = 0
+        self.probation = False
+        self.max_context = None
+        self.context_lock = threading.Lock()
+
+class BackendPool:
+    def __init__(self, urls, headers=None, max_failures=3, eject_seconds=30):
+        if isinstance(urls, str):
+            urls = [urls]
+        urls = [url.strip() for entry in urls for url in entry.split(',') if url.strip()]
+        if not urls:
+            raise ValueError("At least one API URL is required")
+        self.backends = [Backend(url) for url in urls]
+        self.headers = headers or {}
+        self.http = HttpClient(self.headers)
+        self.max_failures = max_failures
+        self.eject_seconds = eject_seconds
+        self.turn = 0
+        self.lock = threading.Condition()
+
+    def __len__(self):
+        return len(self.backends)
+
+    def check_backend(self, backend):
+        try:
+            response = self.http.request('POST', backend.url, "/extra/generate/check", json={'genkey': ''}, max_retries=0)
+            return response.status_code == 200
+        except Exception:
+            return False
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.time()
+                candidates = [b for b in self.backends if b.ejected_until <= now]
+                if not candidates:
+                    wait = min(b.ejected_until for b in self.backends) - now
+                    print(f"All backends are ejected, waiting {wait:.0f}s before retrying")
+                    self.lock.wait(timeout=wait)
+                    continue
+                # Least in-flight first, rotating the starting point so ties spread out
+                count = len(self.backends)
+                self.turn = (self.turn + 1) % count
+                backend = min(candidates, key=lambda b: (b.in_flight, (self.backends.index(b) - self.turn) % count))
+                backend.in_flight += 1
+                probing = backend.probation
+            if not probing or self.check_backend(backend):
+                return backend
+            self.release(backend, ok=False)
+
+    def release(self, backend, ok=True):
+        with self.lock:
+            backend.in_flight -= 1
+            self.mark(backend, ok)
+
+    def mark(self, backend, ok):
+        with self.lock:
+            if ok:
+                backend.failures = 0
+                backend.probation = False
+            else:
+                backend.failures += 1
+                if backend.probation or backend.failures >= self.max_failures:
+                    print(f"Backend {backend.url} failed {backend.failures} times, ejecting for {self.eject_seconds}s")
+                    backend.ejected_until = time.time() + self.eject_seconds
+                    backend.probation = True
+            self.lock.notify_all()
+
+    def get_max_context(self):
+        # Fetched once per backend; the smallest context is safe on every backend
+        values = []
+        for backend in self.backends:
+            if backend.max_context is None and backend.ejected_until <= time.time():
+                self.fetch_context(backend)
+            if backend.max_context:
+                values.append(backend.max_context)
+        return min(values) if values else 0
+
+    def fetch_context(self, backend):
+        # Only workers asking the same backend wait for its answer
+        with backend.context_lock:
+            if backend.max_context is not None:
+                return
+            try:
+                response = self.http.request('GET', backend.url, "/extra/true_max_context_length", max_retries=0)
+                if response.status_code == 200:
+                    backend.max_context = response.json().get('value', 0)
+                elif response.status_code < 500:
+                    # Backends without the endpoint are not asked again
+                    backend.max_context = 0
+                else:
+                    self.mark(backend, False)
+            except Exception as e:
+                print(f"Error in get_max_context for {backend.url}: {e}")
+                self.mark(backend, False)
+
+    def request(self, method, path, json=None):
+        for attempt in range(len(self.backends)):
+            backend = self.acquire()
+            last = attempt == len(self.backends) - 1
+            ok = False
+            try:
+                # Another backend is tried at once; only the last one left is retried with backoff
+                response = self.http.request(method.upper(), backend.url, path, json=json, max_retries=None if last else 0)
+                # koboldcpp answers 503 while busy, which is no reason to eject it
+                ok = response.status_code < 500 or response.status_code == 503
+                if response.status_code < 500 or last:
+                    return response
+            except self.http.httpx.TransportError:
+                if last:
+                    raise
+            finally:
+                self.release(backend, ok)
+
+    def close(self):
+        self.http.close()
+
+class TokenCounter:
+    def __init__(self, backends, model="", cache_size=4096, chars_per_token=3.0, calibration_tokens=2048, margin=0.15):
+        self.backends = backends
+        self.model = model
+        self.cache = OrderedDict()
+        self.cache_size = cache_size
+        self.chars_per_token = chars_per_token
+        self.calibration_tokens = calibration_tokens
+        self.margin = margin
+        self.calibration = {}
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def text_key(text):
+        return hashlib.sha1(text.encode('utf-8', 'surrogatepass')).hexdigest()
+
+    def is_calibrated(self):
+        return self.calibration.get(self.model, (0, 0))[1] >= self.calibration_tokens
+
+    def ratio(self):
+        chars, tokens = self.calibration.get(self.model, (0, 0))
+        if tokens < self.calibration_tokens:
+            return self.chars_per_token
+        return chars / tokens
+
+    def estimate(self, text):
+        if not text:
+            return 0
+        return int(len(text) / self.ratio()) + 1
+
+    def count(self, text):
+        key = self.text_key(text)
+        with self.lock:
+            if key in self.cache:
+                self.cache.move_to_end(key)
+                return self.cache[key]
+        value = self.request_count(text)
+        if value:
+            with self.lock:
+                self.cache[key] = value
+                if len(self.cache) > self.cache_size:
+                    self.cache.popitem(last=False)
+                chars, tokens = self.calibration.get(self.model, (0, 0))
+                self.calibration[self.model] = (chars + len(text), tokens + value)
+        return value
+
+    def count_many(self, texts, max_workers=4):
+        # koboldcpp has no batch endpoint, so dedupe and spread the misses over the pool
+        with self.lock:
+            misses = list({text for text in texts if self.text_key(text) not in self.cache})
+        if misses:
+            with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(misses)))) as pool:
+                list(pool.map(self.count, misses))
+        return [self.count(text) for text in texts]
+
+    def measure(self, text, limit):
+        # Only ask the backend when the estimate is too close to the limit to trust
+        with self.lock:
+            cached = self.cache.get(self.text_key(text))
+        if cached is not None:
+            return cached
+        estimate = self.estimate(text)
+        if self.is_calibrated() and estimate * (1 + self.margin) < limit:
+            return estimate
+        return self.count(text) or estimate
+
+    @profiled('tokencount')
+    def request_count(self, text):
+        try:
+            response = self.backends.request('POST', "/extra/tokencount", json={'prompt': text})
+            if response.status_code == 200:
+                return response.json().get('value', 0)
+        except Exception as e:
+            print(f"Error in get_token_count: {e}")
+        return 0
+
+class JsonGrammar:
+    # Converts the subset of JSON schema used in task configs to a llama.cpp GBNF grammar
+    base_rules = [
+        ('ws', r'" "?'),
+        ('value', r'object | array | string | number | boolean | null'),
+        ('object', r'"{" ws (string ":" ws value ("," ws string ":" ws value)*)? "}" ws'),
+        ('array', r'"[" ws (value ("," ws value)*)? "]" ws'),
+        ('string', r'"\"" ([^"\\\x7F\x00-\x1F] | "\\" (["\\/bfnrt] | "u" [0-9a-fA-F] [0-9a-fA-F] [0-9a-fA-F] [0-9a-fA-F]))* "\"" ws'),
+        ('number', r'"-"? ([0-9] | [1-9] [0-9]*) ("." [0-9]+)? ([eE] [-+]? [0-9]+)? ws'),
+        ('integer', r'"-"? ([0-9] | [1-9] [0-9]*) ws'),
+        ('boolean', r'("true" | "false") ws'),
+        ('null', r'"null" ws'),
+    ]
+    types = ('string', 'number', 'integer', 'boolean', 'null', 'object', 'array')
+
+    def __init__(self, schema):
+        self.rules = OrderedDict()
+        self.names = {'root', *(name for name, _ in self.base_rules)}
+        root = self.visit(schema, 'root')
+        self.rules = OrderedDict([('root', root), *self.rules.items(), *self.base_rules])
+
+    def __str__(self):
+        return "\n".join(f"{name} ::= {body}" for name, body in self.rules.items())
+
+    @staticmethod
+    def literal(text):
+        return '"' + text.replace('\\', '\\\\').replace('"', '\\"') + '"'
+
+    def add_rule(self, name, body):
+        # Keys such as a_b and a-b sanitize to the same name, so later ones get a numbered suffix
+        name = base = re.sub(r'[^a-zA-Z0-9-]+', '-', name)
+        suffix = 2
+        while name in self.names:
+            name = f"{base}-{suffix}"
+            suffix += 1
+        self.names.add(name)
+        self.rules[name] = body
+        return name
+
+    def visit(self, schema, name):
+        if 'enum' in schema:
+            return "(" + " | ".join(self.literal(json.dumps(value)) for value in schema['enum']) + ") ws"
+        schema_type = schema.get('type')
+        if schema_type == 'object' and schema.get('properties'):
+            # Properties are generated in the order given and all of them are required
+            parts = ['"{" ws']
+            for index, (key, subschema) in enumerate(schema['properties'].items()):
+                rule = self.add_rule(f"{name}-{key}", self.visit(subschema, f"{name}-{key}"))
+                separator = '"," ws ' if index else ''
+                parts.append(f'{separator}{self.literal(json.dumps(key))} ws ":" ws {rule}')
+            parts.append('"}" ws')
+            return " ".join(parts)
+        if schema_type == 'array' and schema.get('items'):
+            item = self.add_rule(f"{name}-item", self.visit(schema['items'], f"{name}-item"))
+            return f'"[" ws ({item} ("," ws {item})*)? "]" ws'
+        if schema_type in self.types:
+            return schema_type
+        return 'value'
+
+class PromptTemplate:
+    # A chat template compiled for one instruction into the text around the content, so a prompt is a single join
+    default = {
+        "startTurn": "",
+        "endSystemTurn": "",
+        "endUserTurn": "\n\n",
+        "endTurn": "\n\n",
+        "systemRole": "Below is an instruction that describes a task. Write a response that appropriately completes the request.",
+        "userRole": "### Instruction:",
+        "assistantRole": "### Response:",
+        "prependPrompt": "\n\n",
+        "systemAfterPrepend": "",
+        "postPrompt": "",
+        "memorySystem": "",
+        "memoryUser": "",
+        "responseStart": "",
+        "specialInstructions": ""
+        }
+    fields = ('bos', 'eos', 'startTurn', 'endTurn', 'startSystem', 'systemRole', 'systemAfterPrepend', 'endSystemRole',
+              'memorySystem', 'endSystemTurn', 'startUser', 'userRole', 'roleGap', 'memoryUser', 'endUserRole',
+              'endUserTurn', 'startAssistant', 'assistantRole', 'responseStart', 'prependPrompt', 'postPrompt',
+              'specialInstructions')
+    templates = {}
+    compiled = {}
+    lock = threading.Lock()
+
+    def __init__(self, template, instruction):
+        get = lambda key: template.get(key, '')
+        system_part = (f"{get('bos')}{get('startTurn')}{get('startSystem')}{get('systemRole')}"
+                       f"{get('systemAfterPrepend')}<text>")
+        system_end = f"</text>{get('endSystemRole')}{get('memorySystem')}{get('endSystemTurn')}"
+        user_part = (f"{get('startTurn')}{get('startUser')}{get('userRole')}{get('roleGap')}{get('memoryUser')}"
+                     f"{instruction}{get('endUserRole')}{get('endUserTurn')}")
+        assistant_part = f"{get('startTurn')}{get('startAssistant')}{get('assistantRole')}{get('roleGap')}{get('responseStart')}"
+        self.prefix = f"{get('prependPrompt')}{system_part}"
+        self.suffix = f"{system_end}{user_part}{assistant_part}{get('postPrompt')}{get('endTurn')}{get('eos')}"
+        # The content is always followed by </text>, so stripping the suffix is the same as stripping the prompt
+        if template.get('specialInstructions') == '.rstrip()':
+            self.suffix = self.suffix.rstrip()
+        self.text = self.prefix + self.suffix
+        self.tokens = None
+
+    def render(self, content):
+        return "".join((self.prefix, content, self.suffix))
+
+    @classmethod
+    def load(cls, prompt_config, model):
+        # Read and checked once per config and model, however many processors and files use it
+        key = (prompt_config, model)
+        template = cls.templates.get(key)
+        if template is not None:
+            return template
+        with cls.lock:
+            if key in cls.templates:
+                return cls.templates[key]
+            if prompt_config is None:
+                template = cls.default
+            elif not os.path.exists(prompt_config):
+                print(f"Prompt config {prompt_config} not found; using the default instruct template")
+                template = cls.default
+            else:
+                template = FileUtils.read_from_json(prompt_config).get(model)
+                if not isinstance(template, dict):
+                    print(f"No template for model {model} in {prompt_config}; using the default instruct template")
+                    template = cls.default
+                invalid = [field for field in cls.fields if not isinstance(template.get(field, ''), str)]
+                if invalid:
+                    print(f"Ignoring template fields of model {model} that are not strings: {', '.join(invalid)}")
+                    template = {key: value for key, value in template.items() if key not in invalid}
+            cls.templates[key] = template
+        return template
+
+    @classmethod
+    def compile(cls, prompt_config, model, template, instruction):
+        key = (prompt_config, model, instruction)
+        compiled = cls.compiled.get(key)
+        if compiled is None:
+            compiled = cls.compiled.setdefault(key, cls(template, instruction))
+        return compiled
+
 class LLMProcessor:
-    def __init__(self, api_url, password="", model="", prompt_config=None, chunk_size=512):
+    def __init__(self, api_url, password="", model="", prompt_config=None, chunk_size=512, tokenizer=None, context_margin=32, segmenter='spacy', stream=False, progress_callback=None, poll_interval=2, map_workers=None, image_size=768):
         self.api_url = api_url
         self.password = password
-        self.genkey = f"KCP{''.join(str(random.randint(0, 9)) for _ in range(4))}"
-        self.generated = False
+        self.stream = stream
+        self.progress_callback = progress_callback
+        self.poll_interval = poll_interval
         self.headers = {
             'Content-Type': 'application/json',
-            'Authorization': f'Bearer {self.password}'
         }   
-        self.nlp = English()
-        self.nlp.add_pipe('sentencizer')
+        # httpx rejects the bare 'Bearer ' value an empty password would produce
+        if self.password:
+            self.headers['Authorization'] = f'Bearer {self.password}'
+        # Worker processors share one pool so load is balanced across all of them
+        if isinstance(api_url, BackendPool):
+            self.backends = api_url
+        else:
+            self.backends = BackendPool(api_url, headers=self.headers)
+        self.tokenizer = tokenizer or TokenCounter(self.backends, model=model)
+        self.map_workers = map_workers or 2 * len(self.backends)
+        self.grammars = {}
+        self.image_size = image_size
+        self.timings = []
         self.chunk_size = chunk_size
+        self.context_margin = context_margin
+        self.segmenter = segmenter
         self.prompt_config = prompt_config
         self.model = model
         self.chat_template = {}
         
-    def interrogate_image(self, image_path):
+    @profiled('interrogate')
+    def interrogate_image(self, image_path, image=None):
         try:
-            with open(image_path, "rb") as image_file:
-                base64_image = base64.b64encode(image_file.read()).decode('utf-8')
+            if image is None:
+                image = FileUtils.prepare_image(image_path, self.image_size)
             payload = {
-                'image': base64_image,
+                'image': image['image'],
                 'model': 'clip',  
             }
-            response = requests.post(f"{self.api_url}/sdapi/v1/interrogate", json=payload, headers=self.headers)
+            response = self.backends.request('POST', "/sdapi/v1/interrogate", json=payload)
             if response.status_code == 200:
                 return response.json().get('caption', '')
             else:
@@ -271,94 +2067,430 @@ class LLMProcessor:
             print(f"Error in image interrogation: {e}")
             return None
 
-    def process_text(self, content, task, num_chunks=999):
-        default_template = {
-            "startTurn": "",
-            "endSystemTurn": "",
-            "endUserTurn": "\n\n",
-            "endTurn": "\n\n",
-            "systemRole": "Below is an instruction that describes a task. Write a response that appropriately completes the request.",
-            "userRole": "### Instruction:",
-            "assistantRole": "### Response:",
-            "prependPrompt": "\n\n",
-            "systemAfterPrepend": "",
-            "postPrompt": "",
-            "memorySystem": "",
-            "memoryUser": "",
-            "responseStart": "",
-            "specialInstructions": ""
-            }
- 
-        if self.prompt_config is not None:
-            if os.path.exists(self.prompt_config):
-                templates = FileUtils.read_from_json(self.prompt_config)
-                self.chat_template = templates.get(self.model)
-        else:
-            self.chat_template = default_template
+    def load_template(self):
+        self.chat_template = PromptTemplate.load(self.prompt_config, self.model)
+        return self.chat_template
+
+    def compile_template(self, instruction):
+        return PromptTemplate.compile(self.prompt_config, self.model, self.load_template(), instruction)
+
+    def template_tokens(self, instruction, exact=True):
+        # Counted once per template and instruction; the plan estimates so it never waits on the backends
+        compiled = self.compile_template(instruction)
+        if not exact:
+            return self.tokenizer.estimate(compiled.text)
+        if compiled.tokens is None:
+            tokens = self.tokenizer.count(compiled.text)
+            if not tokens:
+                return self.tokenizer.estimate(compiled.text)
+            compiled.tokens = tokens
+        return compiled.tokens
+
+    @profiled('process_text')
+    def process_text(self, content, task, num_chunks=999, sentences=None):
+        self.load_template()
   
         if task is None:
             return
         
-        cleaned_content = FileUtils.clean_content(content)
-        self.tokens = self.get_token_count(json.dumps(cleaned_content))
+        # Pre-split sentences come from FileUtils.extract_document, already cleaned
+        streamed = isinstance(content, TextStream)
+        cleaned_content = content if sentences is not None or streamed else FileUtils.clean_content(content)
+        self.tokens = int(content.size / self.tokenizer.ratio()) if streamed else self.tokenizer.estimate(cleaned_content)
         self.max_context_length = self.get_max_context()
-        usable_tokens = self.tokens + 200
-        if num_chunks == 0 and (usable_tokens > self.max_context_length):
-            print(f"Cannot fit content into context. Too many tokens: {self.tokens}")
-            num_chunks = math.ceil(usable_tokens / self.max_context_length) 
-            self.chunk_size = int(usable_tokens / num_chunks)
-        elif num_chunks == 0 and (usable_tokens <= self.max_context_length):
+        instruction = task.get('instruction')
+        template_tokens = self.template_tokens(instruction)
+        room = self.max_context_length - template_tokens - self.context_margin
+
+        map_reduce = task.get('mode') == 'map_reduce'
+
+        # num_chunks == 0 sends the whole text and lets the output be as long as the input
+        if num_chunks == 0 and not map_reduce and self.tokens * 2 + 200 <= room:
+            budget = self.tokens
             chunks = [cleaned_content]
-            self.chunk_size = usable_tokens
-        if num_chunks > 0:
-            chunks = self.chunkify(cleaned_content, num_chunks)
+        elif num_chunks == 0 and not map_reduce:
+            print(f"Cannot fit content into context. Too many tokens: {self.tokens}")
+            budget = (room - 200) // 2
+            chunks = None
+        else:
+            budget = min(self.chunk_size, room - self.output_length(task))
+            chunks = None
+        if budget <= 0:
+            print(f"Prompt template leaves no room for content. Template tokens: {template_tokens}, Max: {self.max_context_length}")
+            return None
+        if chunks is None:
+            # Map-reduce covers every chunk, or a sample of map_chunks of them, instead of num_chunks
+            chunks = self.chunkify(cleaned_content, task.get('map_chunks', -1) if map_reduce else num_chunks, sentences=sentences, budget=budget, overlap=task.get('chunk_overlap', 0))
+
+        if map_reduce:
+            return self.map_reduce(chunks, task)
             
         results = []
         for chunk in chunks:
-            prompt = self.get_template(instruction=task.get('instruction'), content=chunk)
-            tokens = self.get_token_count(prompt)
+            results.extend(self.process_chunk(instruction, chunk, task, whole_text=num_chunks == 0))
+
+        if not results:
+            print("API call failed or returned no results")
+            return None
+        return " ".join(results)
+
+    def process_chunk(self, instruction, chunk, task, whole_text=False, output_length=None):
+        results = []
+        pending = [chunk]
+        while pending:
+            chunk = pending.pop()
+            chunk_tokens = self.tokenizer.estimate(chunk)
+            max_length = chunk_tokens + 200 if whole_text else output_length or self.output_length(task)
+            prompt = self.get_template(instruction=instruction, content=chunk)
+            tokens = self.tokenizer.measure(prompt, self.max_context_length - max_length)
             print(f"Tokens in prompt: {tokens}")
             
-            if tokens > self.max_context_length:
-                print(f"Warning: Content exceeds max context length. Tokens: {tokens}, Max: {self.max_context_length}")
-                prompt = prompt[:self.max_context_length]  # This is a naive truncation and might break the prompt 
-                tokens = self.get_token_count(prompt) 
+            if tokens + max_length > self.max_context_length:
+                # The estimate was too optimistic; split the chunk rather than truncate the prompt
+                budget = chunk_tokens // 2
+                if budget <= 0:
+                    print(f"Warning: Skipping chunk that cannot fit into context. Tokens: {tokens}, Max: {self.max_context_length}")
+                    continue
+                pending.extend(reversed(self.pack_sentences(FileUtils.iter_sentences(chunk, self.segmenter), budget)))
+                continue
                 
             payload = {
                 'prompt': prompt,
-                'max_length': self.chunk_size,
+                'max_length': max_length,
                 'max_context_length': self.max_context_length,
+                **self.output_constraints(task),
                 **task.get('parameters', {})
             }
             
             result = self._call_api(payload)
             if result is not None:
                 results.append(result)
+        return results
 
-        if not results:
+    def process_chunk_batches(self, instruction, chunks, task, output_length=None):
+        # Chunks may come from a generator over a streamed file, so only a window of them is held at a time
+        batches = []
+        chunks = iter(chunks)
+        with ThreadPoolExecutor(max_workers=max(1, self.map_workers)) as pool:
+            while True:
+                window = list(itertools.islice(chunks, self.map_workers * 2))
+                if not window:
+                    return batches
+                batches.extend(pool.map(lambda chunk: self.process_chunk(instruction, chunk, task, output_length=output_length), window))
+
+    @profiled('map_reduce')
+    def map_reduce(self, chunks, task, max_levels=8):
+        self.timings = []
+        start = time.time()
+        batches = self.process_chunk_batches(task.get('instruction'), chunks, task)
+        self.record_level(0, len(batches), start)
+        return self.reduce_partials([result for batch in batches for result in batch], task, max_levels)
+
+    def reduce_partials(self, partials, task, max_levels=8):
+        reduce_instruction = task.get('reduce_instruction', task.get('instruction'))
+        template_tokens = self.template_tokens(reduce_instruction)
+        budget = self.max_context_length - template_tokens - self.context_margin - self.output_length(task)
+
+        level = 0
+        while len(partials) > 1 and level < max_levels:
+            groups = self.group_partials(partials, budget)
+            if len(groups) == len(partials):
+                # No two partials fit one prompt, so another level would not shrink anything
+                break
+            level += 1
+            start = time.time()
+            with ThreadPoolExecutor(max_workers=max(1, min(self.map_workers, len(groups)))) as pool:
+                partials = [result for results in pool.map(lambda group: self.reduce_group(reduce_instruction, group, task), groups) for result in results]
+            self.record_level(level, sum(1 for group in groups if len(group) > 1), start)
+
+        if not partials:
             print("API call failed or returned no results")
             return None
-        return " ".join(results)
+        if len(partials) > 1:
+            # Out of levels: reduce the partials that fit one prompt rather than gluing all of them together
+            partials = self.reduce_group(reduce_instruction, self.group_partials(partials, budget)[0], task) or partials
+        return partials[0]
+
+    def reduce_group(self, instruction, group, task):
+        # Groups that turn out too long are split between partials, never inside one; a lone partial passes through
+        results = []
+        pending = [group]
+        while pending:
+            group = pending.pop()
+            if len(group) == 1:
+                results.append(group[0])
+                continue
+            max_length = self.output_length(task)
+            content = "\n\n".join(group)
+            tokens = self.tokenizer.measure(self.get_template(instruction=instruction, content=content), self.max_context_length - max_length)
+            if tokens + max_length > self.max_context_length:
+                half = len(group) // 2
+                pending.extend([group[half:], group[:half]])
+                continue
+            results.extend(self.process_chunk(instruction, content, task))
+        return results
+
+    @profiled('tasks.fused')
+    def process_fused(self, content, tasks, sentences=None):
+        # One request per chunk answers every task, so the document is sent once instead of once per task
+        self.load_template()
+        if sentences is None and not isinstance(content, TextStream):
+            content = FileUtils.clean_content(content)
+            sentences = FileUtils.split_sentences(content, self.segmenter)
+        self.max_context_length = self.get_max_context()
+        instruction = self.fused_instruction(tasks)
+        output_length = sum(self.output_length(task) for task in tasks.values())
+        template_tokens = self.template_tokens(instruction)
+        budget = min(self.chunk_size, self.max_context_length - template_tokens - self.context_margin - output_length)
+        if budget <= 0:
+            print(f"Fused prompt leaves no room for content. Template tokens: {template_tokens}, Max: {self.max_context_length}")
+            return {}
+
+        map_reduce = any(task.get('mode') == 'map_reduce' for task in tasks.values())
+        num_chunks = self.fused_chunks(tasks)
+        overlap = max(task.get('chunk_overlap', 0) for task in tasks.values())
+        chunks = self.chunkify(content, num_chunks, sentences=sentences, budget=budget, overlap=overlap)
+        fused_task = {'parameters': next(iter(tasks.values())).get('parameters', {})}
+        # Per-task stop sequences could cut the combined answer short, so only the schema carries over
+        if not any('grammar' in task for task in tasks.values()):
+            fused_task['json_schema'] = {
+                'type': 'object',
+                'properties': {name: task.get('json_schema', {}) for name, task in tasks.items()}
+            }
+
+        self.timings = []
+        start = time.time()
+        batches = self.process_chunk_batches(instruction, chunks, fused_task, output_length=output_length)
+        if map_reduce:
+            self.record_level(0, len(batches), start)
+
+        partials = {name: [] for name in tasks}
+        for index, batch in enumerate(batches):
+            for answer in batch:
+                parsed = FileUtils.clean_json(answer)
+                if not isinstance(parsed, dict):
+                    continue
+                for name, task in tasks.items():
+                    # The first chunk is always selected, so a task asking for fewer chunks takes a prefix
+                    if not map_reduce and index >= task.get('num_chunks', 999):
+                        continue
+                    if map_reduce and task.get('mode') == 'map_reduce' and 0 < task.get('map_chunks', 0) <= index:
+                        continue
+                    value = parsed.get(name)
+                    if value:
+                        partials[name].append(value if isinstance(value, str) else json.dumps(value))
+
+        # Tasks missing from every answer are left out so the caller can run them on their own
+        results = {}
+        for name, task in tasks.items():
+            if not partials[name]:
+                continue
+            if task.get('mode') == 'map_reduce':
+                results[name] = self.reduce_partials(partials[name], task)
+            else:
+                results[name] = " ".join(partials[name])
+        return results
+
+    def output_length(self, task):
+        return task.get('max_output_tokens', self.chunk_size)
+
+    def fused_chunks(self, tasks):
+        # A fused request covers the most chunks any of its tasks needs; -1 is every chunk
+        if not any(task.get('mode') == 'map_reduce' for task in tasks.values()):
+            return max(task.get('num_chunks', 999) for task in tasks.values())
+        caps = [task.get('map_chunks', -1) if task.get('mode') == 'map_reduce' else -1 for task in tasks.values()]
+        return -1 if min(caps) <= 0 else max(caps)
+
+    def plan_text(self, tokens, task, output_fill=1.0):
+        # Mirrors process_text on a token estimate; returns (calls, prompt tokens, output tokens) without calling the API.
+        # output_fill is the share of max_length an answer is expected to use
+        num_chunks = task.get('num_chunks', 999)
+        template_tokens = self.template_tokens(task.get('instruction'), exact=False)
+        room = self.max_context_length - template_tokens - self.context_margin
+        map_reduce = task.get('mode') == 'map_reduce'
+        if tokens <= 0:
+            return 0, 0, 0
+        if num_chunks == 0 and not map_reduce and tokens * 2 + 200 <= room:
+            return 1, template_tokens + tokens, int((tokens + 200) * output_fill)
+        if num_chunks == 0 and not map_reduce:
+            budget = (room - 200) // 2
+            output_length = budget + 200
+        else:
+            budget = min(self.chunk_size, room - self.output_length(task))
+            output_length = self.output_length(task)
+        if budget <= 0:
+            return 0, 0, 0
+        calls, content_tokens = self.plan_chunks(tokens, budget, task.get('map_chunks', -1) if map_reduce else num_chunks, task.get('chunk_overlap', 0))
+        plan = (calls, calls * template_tokens + content_tokens, int(calls * output_length * output_fill))
+        if map_reduce:
+            plan = tuple(a + b for a, b in zip(plan, self.plan_reduce(calls, task, output_fill)))
+        return plan
+
+    def plan_fused(self, tokens, tasks, output_fill=1.0):
+        instruction = self.fused_instruction(tasks)
+        output_length = sum(self.output_length(task) for task in tasks.values())
+        template_tokens = self.template_tokens(instruction, exact=False)
+        budget = min(self.chunk_size, self.max_context_length - template_tokens - self.context_margin - output_length)
+        if budget <= 0 or tokens <= 0:
+            return 0, 0, 0
+        overlap = max(task.get('chunk_overlap', 0) for task in tasks.values())
+        calls, content_tokens = self.plan_chunks(tokens, budget, self.fused_chunks(tasks), overlap)
+        plan = (calls, calls * template_tokens + content_tokens, int(calls * output_length * output_fill))
+        for task in tasks.values():
+            if task.get('mode') == 'map_reduce':
+                partials = calls if task.get('map_chunks', 0) <= 0 else min(calls, task['map_chunks'])
+                plan = tuple(a + b for a, b in zip(plan, self.plan_reduce(partials, task, output_fill)))
+        return plan
+
+    def plan_chunks(self, tokens, budget, num_chunks, overlap=0):
+        # Chunks are packed close to the budget, each repeating the overlap of the one before
+        overlap = min(overlap, budget // 2)
+        total = max(1, -(-(tokens - overlap) // (budget - overlap)))
+        calls = total if num_chunks <= 0 else min(num_chunks, total)
+        return calls, (tokens + overlap * (total - 1)) * calls // total
+
+    def plan_reduce(self, partials, task, output_fill=1.0, max_levels=8):
+        reduce_instruction = task.get('reduce_instruction', task.get('instruction'))
+        template_tokens = self.template_tokens(reduce_instruction, exact=False)
+        output_length = self.output_length(task)
+        budget = self.max_context_length - template_tokens - self.context_margin - output_length
+        partial_tokens = max(1, int(output_length * output_fill)) + 2
+        per_group = budget // partial_tokens
+        calls = prompt_tokens = 0
+        if per_group < 2:
+            return 0, 0, 0
+        level = 0
+        while partials > 1 and level < max_levels:
+            level += 1
+            groups = -(-partials // per_group)
+            calls += groups
+            prompt_tokens += groups * template_tokens + partials * partial_tokens
+            partials = groups
+        if partials > 1:
+            calls += 1
+            prompt_tokens += template_tokens + min(partials, per_group) * partial_tokens
+        return calls, prompt_tokens, int(calls * output_length * output_fill)
+
+    def output_constraints(self, task):
+        constraints = {}
+        grammar = task.get('grammar')
+        if grammar is None and 'json_schema' in task:
+            key = json.dumps(task['json_schema'], sort_keys=True)
+            if key not in self.grammars:
+                self.grammars[key] = str(JsonGrammar(task['json_schema']))
+            grammar = self.grammars[key]
+        if grammar:
+            constraints['grammar'] = grammar
+        if task.get('stop_sequences'):
+            constraints['stop_sequence'] = task['stop_sequences']
+        return constraints
+
+    def fused_instruction(self, tasks):
+        keys = ", ".join(f'"{name}"' for name in tasks)
+        lines = "\n".join(f"{name}: {task.get('instruction')}" for name, task in tasks.items())
+        return (f"Complete each of the following tasks for the text. Reply with only a JSON object "
+                f"with the keys {keys}, each holding the answer to that task.\n\n{lines}")
+
+    def group_partials(self, partials, budget):
+        # Greedy token-bounded groups; a partial that does not fit with the ones before starts a new group
+        groups = []
+        current = []
+        current_tokens = 0
+        for partial in partials:
+            partial_tokens = self.tokenizer.estimate(partial) + 2
+            if current and current_tokens + partial_tokens > budget:
+                groups.append(current)
+                current, current_tokens = [], 0
+            current.append(partial)
+            current_tokens += partial_tokens
+        if current:
+            groups.append(current)
+        return groups
+
+    def record_level(self, level, calls, start):
+        elapsed = time.time() - start
+        self.timings.append({'level': level, 'calls': calls, 'seconds': round(elapsed, 3)})
+        print(f"Map-reduce level {level}: {calls} calls in {elapsed:.1f}s")
         
-    def chunkify(self, content, num_chunks=999):
-        doc = self.nlp(content)
-        sentences = list(doc.sents)
+    @profiled('chunkify')
+    def chunkify(self, content, num_chunks=999, sentences=None, budget=None, overlap=0):
+        if isinstance(content, TextStream):
+            return self.chunkify_stream(content, num_chunks, budget or self.chunk_size, overlap)
+        if sentences is None:
+            sentences = FileUtils.iter_sentences(content, self.segmenter)
+        chunks = self.pack_sentences(sentences, budget or self.chunk_size, overlap)
+        return self.select_chunks(chunks, num_chunks)
+
+    def chunkify_stream(self, stream, num_chunks, budget, overlap=0):
+        # The first chunk plus one from a random point in each later stretch of the file; nothing past them is read
+        estimated_chunks = stream.size / (budget * self.tokenizer.ratio())
+        if num_chunks <= 0 or num_chunks >= estimated_chunks:
+            return self.iter_packed(stream.iter_sentences(self.segmenter), budget, overlap)
+        stretch = (stream.size - stream.start) / num_chunks
+        block_size = max(4096, int(budget * self.tokenizer.ratio() * 4))
         chunks = []
-        if not self.tokens:
-            self.tokens = self.get_token_count(json.dumps(content))
-            
-        avg_tokens_per_sentence = max(1, int(self.tokens / len(sentences)))
-       
-        try:
-            sentences_per_chunk = max(1, int(self.chunk_size / avg_tokens_per_sentence))
-        except:
-            print("Average tokens not valid -- check API connectivity")
-            chunks = [0,'error']
-            return chunks
-        for i in range(0, len(sentences), sentences_per_chunk):
-            chunk = sentences[i:i + sentences_per_chunk]
-            chunks.append(" ".join(str(sent) for sent in chunk))
-        
+        for index in range(num_chunks):
+            start = None if index == 0 else stream.start + int(stretch * (index + random.random()))
+            chunk = next(self.iter_packed(stream.iter_sentences(self.segmenter, start, block_size), budget), None)
+            if chunk:
+                chunks.append(chunk)
+        return chunks
+
+    def pack_sentences(self, sentences, budget, overlap=0):
+        return list(self.iter_packed(sentences, budget, overlap))
+
+    def iter_packed(self, sentences, budget, overlap=0):
+        current = []
+        current_tokens = 0
+        for sentence in sentences:
+            for piece in self.split_oversized(sentence, budget):
+                # One extra token per piece covers the joining space
+                piece_tokens = self.tokenizer.estimate(piece) + 1
+                if current and current_tokens + piece_tokens > budget:
+                    yield " ".join(current)
+                    current, current_tokens = self.overlap_tail(current, overlap, budget - piece_tokens)
+                current.append(piece)
+                current_tokens += piece_tokens
+        if current:
+            yield " ".join(current)
+
+    def overlap_tail(self, pieces, overlap, limit):
+        tail = []
+        tail_tokens = 0
+        for piece in reversed(pieces):
+            piece_tokens = self.tokenizer.estimate(piece) + 1
+            if tail_tokens + piece_tokens > min(overlap, limit):
+                break
+            tail.insert(0, piece)
+            tail_tokens += piece_tokens
+        return tail, tail_tokens
+
+    def split_oversized(self, sentence, budget):
+        if self.tokenizer.estimate(sentence) < budget:
+            return [sentence]
+        pieces = []
+        current = []
+        current_tokens = 0
+        for word in sentence.split():
+            word_tokens = self.tokenizer.estimate(word) + 1
+            if word_tokens >= budget:
+                # A single run without spaces (base64, tables) is cut by characters
+                step = max(1, int((budget - 1) * self.tokenizer.ratio()))
+                if current:
+                    pieces.append(" ".join(current))
+                pieces.extend(word[i:i + step] for i in range(0, len(word), step))
+                current, current_tokens = [], 0
+                continue
+            if current and current_tokens + word_tokens > budget:
+                pieces.append(" ".join(current))
+                current, current_tokens = [], 0
+            current.append(word)
+            current_tokens += word_tokens
+        if current:
+            pieces.append(" ".join(current))
+        return pieces
+
+    def select_chunks(self, chunks, num_chunks):
         if num_chunks > 0:
             if num_chunks >= len(chunks):
                 return chunks
@@ -370,102 +2502,116 @@ class LLMProcessor:
                 return selected_chunks
             elif num_chunks == 1:
                 return [chunks[0]]  # If num_chunks is 1, return only the first chunk
-            else:
-                chunks = [0, 'error']
         return chunks
         	
     def get_template(self, instruction, content):
-        template = self.chat_template
-        system_part = (f"{template.get('bos', '')}"
-                       f"{template.get('startTurn', '')}"
-                       f"{template.get('startSystem', '')}"
-                       f"{template.get('systemRole', '')}"
-                       f"{template.get('systemAfterPrepend', '')}"
-                       f"<text>{content}</text>"
-                       f"{template.get('endSystemRole', '')}"
-                       f"{template.get('memorySystem', '')}"
-                       f"{template.get('endSystemTurn', '')}")
-
-        # Construct user part
-        user_part = (f"{template.get('startTurn', '')}"
-                     f"{template.get('startUser', '')}"
-                     f"{template.get('userRole', '')}"
-                     f"{template.get('roleGap', '')}"
-                     f"{template.get('memoryUser', '')}"
-                     f"{instruction}"
-                     
-                     f"{template.get('endUserRole', '')}"
-                     f"{template.get('endUserTurn', '')}")
-
-        # Construct assistant part
-        assistant_part = (f"{template.get('startTurn', '')}"
-                          f"{template.get('startAssistant', '')}"
-                          f"{template.get('assistantRole', '')}"
-                          f"{template.get('roleGap', '')}"
-                          f"{template.get('responseStart', '')}")
-
-        # Combine all parts
-        prompt = (f"{template.get('prependPrompt', '')}"
-                  f"{system_part}"
-                  f"{user_part}"
-                  f"{assistant_part}"
-                  f"{template.get('postPrompt', '')}"
-                  f"{template.get('endTurn', '')}"
-                  f"{template.get('eos', '')}")
+        return self.compile_template(instruction).render(content)
 
-        if template.get('specialInstructions') == '.rstrip()':
-            prompt = prompt.rstrip()
-
-        return prompt
+    @staticmethod
+    def new_genkey():
+        return f"KCP{''.join(str(random.randint(0, 9)) for _ in range(8))}"
 
     def _call_api(self, payload):
-        payload['genkey'] = str(self.genkey)
-        self.generated = False
-        poll_thread = threading.Thread(target=self.poll_generation_status)
-        poll_thread.start()
+        # Each request gets its own genkey so concurrent requests never share progress
+        payload['genkey'] = self.new_genkey()
+        # A failed backend is retried on the next healthy one before giving up
+        for _ in range(len(self.backends)):
+            backend = self.backends.acquire()
+            ok = False
+            try:
+                if self.stream:
+                    ok, result = self._stream_generate(backend.url, payload)
+                else:
+                    ok, result = self._generate(backend.url, payload)
+                if ok:
+                    return result
+            except Exception as e:
+                print(f"Error communicating with API at {backend.url}: {str(e)}")
+            finally:
+                self.backends.release(backend, ok)
+        return None
+
+    @profiled('generate')
+    def _generate(self, api_url, payload):
+        done = None
+        if self.progress_callback is not None:
+            done = threading.Event()
+            threading.Thread(target=self.poll_generation_status, args=(api_url, payload['genkey'], done), daemon=True).start()
         try:
-            response = requests.post(f"{self.api_url}/v1/generate/", json=payload, headers=self.headers)
-            if response.status_code == 200:
-                self.generated = True
-                poll_thread.join()
-                result = response.json()
-                if 'results' in result and len(result['results']) > 0:
-                    return result['results'][0].get('text')
-        except Exception as e:
-            print(f"Error communicating with API: {str(e)}")
+            response = self.backends.http.request('POST', api_url, "/v1/generate/", json=payload)
         finally:
-            self.generated = True
-        return None
+            if done is not None:
+                done.set()
+        if response.status_code != 200:
+            return response.status_code < 500, None
+        result = response.json()
+        if 'results' in result and len(result['results']) > 0:
+            return True, result['results'][0].get('text')
+        return True, None
+
+    @profiled('generate.stream')
+    def _stream_generate(self, api_url, payload):
+        tokens = []
+        data_lines = []
+        # Only the line being written is shown, so joining every token so far on each token is avoided
+        open_line = ""
+        last_line = ""
+
+        def on_line(line):
+            nonlocal open_line, last_line
+            if line.startswith('data:'):
+                data_lines.append(line[5:].strip())
+                return
+            if line or not data_lines:
+                return
+            # A blank line ends one server-sent event
+            event = json.loads("\n".join(data_lines))
+            data_lines.clear()
+            token = event.get('token', '')
+            if token:
+                tokens.append(token)
+                if self.progress_callback is not None:
+                    lines = (open_line + token).split("\n")
+                    open_line = lines[-1][-200:]
+                    last_line = next((line for line in reversed(lines) if line.strip()), last_line)[-200:]
+                    self.progress_callback(payload['genkey'], last_line)
+
+        status_code, streamed = self.backends.http.stream_lines(api_url, "/extra/generate/stream", json=payload, on_line=on_line)
+        if not streamed:
+            return status_code < 500, None
+        return True, "".join(tokens)
 
-    def poll_generation_status(self):
-        payload = {'genkey': self.genkey}
-        while not self.generated:
+    def poll_generation_status(self, api_url, genkey, done):
+        payload = {'genkey': genkey}
+        while not done.wait(self.poll_interval):
             try:
-                response = requests.post(f"{self.api_url}/extra/generate/check", json=payload, headers=self.headers)
+                response = self.backends.http.request('POST', api_url, "/extra/generate/check", json=payload, max_retries=0)
                 if response.status_code == 200:
                     result = response.json().get('results')[0].get('text')
-                    os.system('cls' if os.name == 'nt' else 'clear')
-                    print(f"\r{result} ", end="\n", flush=True)
+                    if not done.is_set():
+                        self.progress_callback(genkey, result)
             except Exception as e:
                 print(e)
                 return
-            time.sleep(2)
 			
     def get_token_count(self, content):
-        payload = {'prompt': content, 'genkey': self.genkey}
-        try:
-            response = requests.post(f"{self.api_url}/extra/tokencount", json=payload, headers=self.headers)
-            if response.status_code == 200:
-                return response.json().get('value', 0)
-        except Exception as e:
-            print(f"Error in get_token_count: {e}")
-            return 0
+        return self.tokenizer.count(content)
 			
     def get_max_context(self):
-        try:
-            response = requests.get(f"{self.api_url}/extra/true_max_context_length", headers=self.headers)
-            if response.status_code == 200:
-                return response.json().get('value', 0)
-        except Exception as e:
-            print(f"Error in get_max_context: {e}")
-            return 0
\ No newline at end of file
+        return self.backends.get_max_context()
+
+    def get_throughput(self):
+        # koboldcpp reports the timings of its last generation, so nothing has to be generated to read them
+        rates = []
+        for backend in self.backends.backends:
+            try:
+                response = self.backends.http.request('GET', backend.url, "/extra/perf", max_retries=0)
+                perf = response.json() if response.status_code == 200 else {}
+            except Exception as e:
+                print(f"Error reading throughput from {backend.url}: {e}")
+                continue
+            if all(perf.get(key) for key in ('last_input_count', 'last_process', 'last_token_count', 'last_eval')):
+                rates.append((perf['last_input_count'] / perf['last_process'], perf['last_token_count'] / perf['last_eval']))
+        if not rates:
+            return None
+        return sum(rate[0] for rate in rates) / len(rates), sum(rate[1] for rate in rates) / len(rates)